@@ -0,0 +1,4 @@
+#!/bin/bash
+set -e
+source ~/alyxvenv/bin/activate
+/var/www/alyx-main/alyx/manage.py ibl gallery_table
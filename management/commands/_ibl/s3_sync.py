@@ -0,0 +1,266 @@
+"""
+In-process equivalent of `aws s3 sync --delete` for session folders, built on boto3.
+
+A single S3 client and transfer manager are shared by all the sessions synced, so that the
+connection pool, the credentials and the bandwidth cap are shared between concurrent syncs.
+
+>>> engine = S3Sync('ibl-brain-wide-map-private', profile='ibladmin', max_bandwidth=100 * 1024 ** 2)
+>>> result = engine.sync('/mnt/ibl/lab/Subjects/subject/2020-01-01/001', 'data/lab/Subjects/subject/2020-01-01/001')
+>>> engine.shutdown()
+"""
+import hashlib
+import logging
+import os
+import posixpath
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+
+_logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncResult:
+    """Operations performed by a sync"""
+    uploaded: list = field(default_factory=list)
+    deleted: list = field(default_factory=list)
+    bytes: int = 0
+
+
+def local_etag(filename, chunk_size):
+    """
+    Compute the S3 ETag of a local file, for a given multipart chunk size.
+
+    Objects uploaded in a single part have the MD5 of their content as ETag; multipart objects
+    have the MD5 of the concatenated MD5s of the parts, suffixed by the number of parts.
+    """
+    md5s = []
+    with open(filename, 'rb') as fp:
+        while chunk := fp.read(chunk_size):
+            md5s.append(hashlib.md5(chunk))
+    if len(md5s) <= 1:
+        return (md5s[0] if md5s else hashlib.md5()).hexdigest()
+    digest = hashlib.md5(b''.join(m.digest() for m in md5s)).hexdigest()
+    return f'{digest}-{len(md5s)}'
+
+
+def scan_files(local_dir):
+    """
+    List the files under a local folder once, with their stat.
+
+    :return: A map of the relative path of the files to their os.stat_result
+    """
+    files = {}
+
+    def scan(directory, relative):
+        try:
+            it = os.scandir(directory)
+        except FileNotFoundError:
+            return
+        with it:
+            for entry in it:
+                if entry.is_dir():
+                    scan(entry.path, f'{relative}{entry.name}/')
+                elif entry.is_file():
+                    files[relative + entry.name] = entry.stat()
+
+    scan(local_dir, '')
+    return files
+
+
+def check_local_dir(local_dir):
+    """Raise if a local folder does not exist, e.g. when its file system is not mounted"""
+    if not Path(local_dir).is_dir():
+        raise FileNotFoundError(f'The local folder "{local_dir}" does not exist')
+
+
+def check_deletes(local_dir, n_local, deletes):
+    """
+    Refuse to delete the objects of a prefix when no file is found locally.
+
+    An empty local folder is more likely a file system issue than a deliberate removal.
+    """
+    if deletes and n_local == 0:
+        raise RuntimeError(f'No local file found in "{local_dir}"; refusing to delete all '
+                           f'{len(deletes)} remote object(s)')
+
+
+class S3Sync:
+    """Sync local folders with S3 prefixes using a shared boto3 client and transfer manager"""
+
+    def __init__(self, bucket_name, profile=None, max_concurrency=10, max_bandwidth=None,
+                 compare_etag=False, client=None):
+        """
+        :param bucket_name: The S3 bucket name, with or without the s3:// scheme
+        :param profile: The AWS profile of the credentials
+        :param max_concurrency: The maximum number of concurrent part uploads
+        :param max_bandwidth: The bandwidth cap of all the uploads, in bytes per second
+        :param compare_etag: If true, files of same size are compared by ETag, i.e. content,
+         otherwise by modification time like the AWS CLI
+        :param client: An S3 client, by default created from the profile
+        """
+        self.bucket_name = bucket_name.replace('s3://', '').strip('/')
+        if client is None:
+            session = boto3.Session(profile_name=profile)
+            client = session.client('s3', config=Config(max_pool_connections=max_concurrency * 2))
+        self.client = client
+        self.config = TransferConfig(max_concurrency=max_concurrency, max_bandwidth=max_bandwidth)
+        self.transfer = create_transfer_manager(self.client, self.config)
+        self.compare_etag = compare_etag
+
+    def list_prefix(self, prefix, folder=None):
+        """
+        Return a map of the relative key to (size, ETag, last modified) of all objects under a prefix
+
+        :param prefix: The S3 prefix, without the bucket name
+        :param folder: If provided, only the objects directly in this folder, relative to the
+         prefix, are listed, otherwise all the objects under the prefix
+        """
+        prefix = prefix.strip('/') + '/'
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if folder is not None:
+            kwargs.update(Prefix=prefix + (folder.strip('/') + '/' if folder.strip('/') else ''), Delimiter='/')
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                objects[obj['Key'][len(prefix):]] = (obj['Size'], obj['ETag'].strip('"'), obj['LastModified'])
+        return objects
+
+    def needs_upload(self, filename, remote, stat=None):
+        """
+        Whether a local file differs from its (size, ETag, last modified) remote counterpart
+
+        :param filename: The local file path
+        :param remote: The (size, ETag, last modified) of the remote object, or None
+        :param stat: The os.stat_result of the local file, if already known
+        """
+        if remote is None:
+            return True
+        size, etag, last_modified = remote
+        stat = stat or os.stat(filename)
+        if stat.st_size != size:
+            return True
+        if self.compare_etag:
+            return local_etag(filename, self.config.multipart_chunksize) != etag
+        # S3 modification times have a resolution of a second
+        return datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc) > last_modified
+
+    def diff(self, local_dir, prefix, files=None, local=None):
+        """
+        Compare a local folder with an S3 prefix.
+
+        :param local_dir: The local folder
+        :param prefix: The S3 prefix, without the bucket name
+        :param files: Optional relative paths of the local files to consider, by default all
+        :param local: The local files and their stat, as returned by scan_files, if already listed
+        :return: list of relative paths to upload, list of relative keys absent locally
+        """
+        local_dir = Path(local_dir)
+        remote = self.list_prefix(prefix)
+        if local is None:
+            local = scan_files(local_dir)  # the local folder is listed and stat'ed once
+        files = local.keys() if files is None else set(files) & local.keys()
+        uploads = sorted(f for f in files if self.needs_upload(local_dir / f, remote.get(f), local[f]))
+        deletes = sorted(k for k in remote if k not in local)
+        return uploads, deletes
+
+    def upload(self, local_dir, prefix, files, dry=False):
+        """
+        Upload files of a local folder to an S3 prefix, using multipart concurrency.
+
+        :return: A SyncResult of the files uploaded
+        """
+        result = SyncResult()
+        futures = []
+        for relative_path in files:
+            filename = Path(local_dir) / relative_path
+            key = f'{prefix.strip("/")}/{relative_path}'
+            _logger.debug(f'{"(dryrun) " if dry else ""}upload: {filename} to s3://{self.bucket_name}/{key}')
+            result.uploaded.append(relative_path)
+            result.bytes += filename.stat().st_size
+            if not dry:
+                futures.append(self.transfer.upload(str(filename), self.bucket_name, key))
+        for future in futures:
+            future.result()  # raises the upload error, if any
+        return result
+
+    def delete(self, prefix, keys, dry=False):
+        """Delete relative keys under an S3 prefix, in batches of 1000"""
+        keys = [f'{prefix.strip("/")}/{k}' for k in keys]
+        for key in keys:
+            _logger.debug(f'{"(dryrun) " if dry else ""}delete: s3://{self.bucket_name}/{key}')
+        if dry:
+            return
+        for i in range(0, len(keys), 1000):
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name, Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True})
+            if errors := response.get('Errors'):
+                raise RuntimeError(f'Failed to delete {len(errors)} object(s), e.g. {errors[0]}')
+
+    def sync(self, local_dir, prefix, delete=True, dry=False):
+        """
+        Sync a local folder with an S3 prefix: upload the new and changed files and, optionally,
+        delete the objects that do not exist locally.
+
+        :param local_dir: The local folder
+        :param prefix: The S3 prefix, without the bucket name
+        :param delete: If true, delete the objects absent from the local folder
+        :param dry: If true, only log the operations
+        :return: A SyncResult of the files uploaded and deleted
+        :raises FileNotFoundError: If the local folder does not exist
+        """
+        check_local_dir(local_dir)
+        local = scan_files(local_dir)
+        uploads, deletes = self.diff(local_dir, prefix, local=local)
+        result = self.upload(local_dir, prefix, uploads, dry=dry)
+        if delete:
+            check_deletes(local_dir, len(local), deletes)
+            self.delete(prefix, deletes, dry=dry)
+            result.deleted = deletes
+        return result
+
+    def sync_files(self, local_dir, prefix, files, delete=False, dry=False):
+        """
+        Sync only the given files of a local folder with an S3 prefix: upload those that are new
+        or changed and, optionally, delete the objects that do not exist locally.
+
+        Unlike `sync`, only the given files are stat'ed and only the folders containing them are
+        listed on S3. The whole prefix is listed, and the local folder walked, only to reconcile
+        the deletions; these are detected from the names of the local files.
+
+        :param local_dir: The local folder
+        :param prefix: The S3 prefix, without the bucket name
+        :param files: The relative paths of the local files to sync
+        :param delete: If true, delete the objects absent from the local folder
+        :param dry: If true, only log the operations
+        :return: A SyncResult of the files uploaded and deleted
+        :raises FileNotFoundError: If the local folder does not exist
+        """
+        check_local_dir(local_dir)
+        local_dir = Path(local_dir)
+        files = set(files)
+        if delete:
+            remote = self.list_prefix(prefix)
+        else:
+            remote = {}
+            for folder in sorted({posixpath.dirname(f) for f in files}):
+                remote.update(self.list_prefix(prefix, folder=folder))
+        uploads = sorted(f for f in files if self.needs_upload(local_dir / f, remote.get(f)))
+        result = self.upload(local_dir, prefix, uploads, dry=dry)
+        if delete:
+            local_files = set()
+            for root, _, filenames in os.walk(local_dir):
+                relative_root = Path(root).relative_to(local_dir)
+                local_files.update((relative_root / f).as_posix() for f in filenames)
+            result.deleted = sorted(k for k in remote if k not in local_files)
+            check_deletes(local_dir, len(local_files), result.deleted)
+            self.delete(prefix, result.deleted, dry=dry)
+        return result
+
+    def shutdown(self):
+        self.transfer.shutdown()
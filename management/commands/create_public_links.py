@@ -4,11 +4,19 @@ Django management command to create symlinks in publicly available folder.
 This command needs to be run on the SDSC server with alyxvenv activated.
 
 Usage:
-    python manage.py create_public_links [--tags TAG1 TAG2 ...]
+    python manage.py create_public_links [--tags TAG1 TAG2 ...] [--batched] [--workers N]
+                                         [--incremental] [--manifest PATH]
 
 Arguments:
     --tags          Optional list of Tag names to process. If provided, only datasets with these tags
                     will be processed. If not provided, all datasets in the public database will be processed.
+    --batched       Group the file records by directory: each source and destination directory is
+                    listed once and the directories are processed by a pool of threads.
+    --workers       Number of directories processed concurrently in batched mode (default 16).
+    --incremental   Batched mode restricted to the datasets added or modified since the last
+                    incremental run, according to the manifest of the links created. The links of
+                    the datasets withdrawn from the public database are removed.
+    --manifest      Path of the links manifest (default ~/Documents/.public_links.sqlite).
 
 Examples:
     # Process all datasets in the public database
@@ -17,20 +25,136 @@ Examples:
     # Process only datasets with specific tags
     python manage.py openalyx --tags IBL-learning IBL-behavior
 
+    # Process all datasets, listing each directory once instead of checking each file
+    python manage.py create_public_links --batched --workers 32
+
+    # Routine run after a release: only process the changes since the last incremental run
+    python manage.py create_public_links --incremental
+
 Notes:
     - The command checks if all datasets have a file record on Flatiron
     - It creates symlinks from /mnt/ibl/[path] to /mnt/ibl/public/[path]
     - Missing source files are reported but don't stop the process
     - Existing symlinks are skipped
+    - The manifest records the link created for each dataset. Only incremental runs without tags
+      advance the time since which datasets are considered modified, and detect withdrawn datasets.
 """
 
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import tqdm
 
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
 from data.models import Dataset, FileRecord
 
+SOURCE_ROOT = Path('/mnt/ibl')
+PUBLIC_ROOT = Path('/mnt/ibl/public')
+manifest_file = Path.home().joinpath('Documents', '.public_links.sqlite')
+
+
+class LinkManifest:
+    """
+    Manifest of the public links, stored in a SQLite database.
+
+    It records the start and end times of the incremental runs over all the public datasets and,
+    for each dataset, the path of its link.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = Path(filepath or manifest_file)
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(self.filepath)
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS runs '
+                             '(id INTEGER PRIMARY KEY, start TEXT NOT NULL, end TEXT)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS links '
+                             '(dataset TEXT PRIMARY KEY, link TEXT NOT NULL)')
+
+    def last_run(self):
+        """Return the start time of the last complete run, or None"""
+        start, = self.con.execute('SELECT MAX(start) FROM runs WHERE end IS NOT NULL').fetchone()
+        return datetime.fromisoformat(start) if start else None
+
+    def start_run(self):
+        """Record the start of a run and return its id"""
+        with self.con:
+            cursor = self.con.execute('INSERT INTO runs (start) VALUES (?)', (timezone.now().isoformat(),))
+        return cursor.lastrowid
+
+    def end_run(self, run_id):
+        """Record the end of a complete run"""
+        with self.con:
+            self.con.execute('UPDATE runs SET end = ? WHERE id = ?', (timezone.now().isoformat(), run_id))
+
+    def datasets(self):
+        """Return the set of dataset ids in the manifest"""
+        return {dataset for dataset, in self.con.execute('SELECT dataset FROM links')}
+
+    def links(self, datasets):
+        """Return a map of dataset id to link path"""
+        datasets = [str(d) for d in datasets]
+        links = {}
+        for i in range(0, len(datasets), 500):  # SQLite limits the number of parameters
+            chunk = datasets[i:i + 500]
+            query = f'SELECT dataset, link FROM links WHERE dataset IN ({",".join("?" * len(chunk))})'
+            links.update(self.con.execute(query, chunk))
+        return links
+
+    def record(self, links):
+        """Record an iterable of (dataset id, link path)"""
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO links (dataset, link) VALUES (?, ?)',
+                                 ((str(d), str(link)) for d, link in links))
+
+    def remove(self, datasets):
+        """Remove datasets from the manifest"""
+        with self.con:
+            self.con.executemany('DELETE FROM links WHERE dataset = ?', ((str(d),) for d in datasets))
+
+    def close(self):
+        self.con.close()
+
+
+def list_names(directory):
+    """Return the set of entry names of a directory, empty if the directory does not exist"""
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name for entry in it}
+    except FileNotFoundError:
+        return set()
+
+
+def link_directory(rel_dir, names):
+    """
+    Create the missing symlinks of a public directory to their source files.
+
+    The source and destination directories are each listed once, instead of checking the
+    existence of every file.
+
+    :param rel_dir: the directory relative to the source and public roots
+    :param names: the file names to link in this directory
+    :return: the number of links created, the number of links that already existed, the
+     list of missing source files and the list of names linked, created or existing
+    """
+    source_dir, dest_dir = SOURCE_ROOT.joinpath(rel_dir), PUBLIC_ROOT.joinpath(rel_dir)
+    sources = list_names(source_dir)
+    missing = [source_dir.joinpath(name) for name in names if name not in sources]
+    names = [name for name in names if name in sources]
+    existing = list_names(dest_dir) if names else set()
+    to_link = [name for name in names if name not in existing]
+    if to_link:
+        dest_dir.mkdir(exist_ok=True, parents=True)
+    for name in to_link:
+        dest_dir.joinpath(name).symlink_to(source_dir.joinpath(name))
+    return len(to_link), len(names) - len(to_link), missing, names
+
 
 class Command(BaseCommand):
     help = 'Create symlinks for publicly released datasets on SDSC server'
@@ -38,6 +162,16 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--tags', nargs='+', type=str,
                             help='Optional list of Tag names to process.')
+        parser.add_argument('--batched', action='store_true',
+                            help='List each source and destination directory once and process the '
+                                 'directories concurrently.')
+        parser.add_argument('--workers', default=16, type=int,
+                            help='Number of directories processed concurrently in batched mode.')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only process the datasets added or modified since the last incremental run, '
+                                 'and remove the links of the withdrawn datasets.')
+        parser.add_argument('--manifest', type=Path, default=None,
+                            help='Path of the links manifest used by incremental runs.')
 
     def handle(self, *args, **options):
         tag_names = options.get('tags')
@@ -50,24 +184,24 @@ class Command(BaseCommand):
             datasets = Dataset.objects.using('public').filter(tags__name__in=tag_names).distinct()
             self.stdout.write(self.style.SUCCESS(f'Found {datasets.count()} datasets with specified tags'))
 
-        ndsets = datasets.count()
-
-        # Check that all datasets have an FI file record, otherwise flag
-        file_records = FileRecord.objects.using('public').filter(
-            data_repository__name__startswith='flatiron',
-            dataset__in=datasets
-        ).order_by('-dataset__auto_datetime')
-
-        if file_records.count() == ndsets:
-            self.stdout.write(self.style.SUCCESS(f'All {ndsets} datasets have file records on Flatiron.'))
-        else:
-            diffs = datasets.values_list('id', flat=True).difference(file_records.values_list('dataset_id', flat=True))
-            self.stdout.write(self.style.WARNING(f'Warning: {len(diffs)} datasets are missing file records on Flatiron:'))
-            for diff in diffs:
-                self.stdout.write(f'...no file record for dataset with ID: {str(diff)}')
+        if options.get('incremental'):
+            manifest = LinkManifest(options.get('manifest'))
+            try:
+                # Only the runs over all the datasets advance the time since which datasets are modified
+                run_id = manifest.start_run() if tag_names is None else None
+                datasets = self.pending_datasets(datasets, manifest, withdraw=tag_names is None)
+                file_records = self.flatiron_file_records(datasets)
+                self.create_links_batched(file_records, workers=options.get('workers'), manifest=manifest)
+                if run_id is not None:
+                    manifest.end_run(run_id)
+            finally:
+                manifest.close()
+            return
 
-        # Create symlinks for all file records
-        self.stdout.write(self.style.SUCCESS(f'Creating symlinks for {file_records.count()} file records...'))
+        file_records = self.flatiron_file_records(datasets)
+        if options.get('batched'):
+            self.create_links_batched(file_records, workers=options.get('workers'))
+            return
         created = 0
         skipped = 0
         missing = 0
@@ -91,3 +225,106 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(
             f'Summary: {created} symlinks created, {skipped} already existed, {missing} source files missing'
         ))
+
+    def flatiron_file_records(self, datasets):
+        """Return the Flatiron file records of the datasets, flagging the datasets without one"""
+        ndsets = datasets.count()
+
+        # Check that all datasets have an FI file record, otherwise flag
+        file_records = FileRecord.objects.using('public').filter(
+            data_repository__name__startswith='flatiron',
+            dataset__in=datasets
+        ).select_related('data_repository').order_by('-dataset__auto_datetime')
+
+        if file_records.count() == ndsets:
+            self.stdout.write(self.style.SUCCESS(f'All {ndsets} datasets have file records on Flatiron.'))
+        else:
+            diffs = datasets.values_list('id', flat=True).difference(file_records.values_list('dataset_id', flat=True))
+            self.stdout.write(self.style.WARNING(f'Warning: {len(diffs)} datasets are missing file records on Flatiron:'))
+            for diff in diffs:
+                self.stdout.write(f'...no file record for dataset with ID: {str(diff)}')
+
+        # Create symlinks for all file records
+        self.stdout.write(self.style.SUCCESS(f'Creating symlinks for {file_records.count()} file records...'))
+        return file_records
+
+    def pending_datasets(self, datasets, manifest, withdraw=True):
+        """
+        Restrict the datasets to those absent from the manifest or modified since its last run,
+        and remove the links of the manifest datasets withdrawn from the public database.
+
+        :param datasets: queryset of public datasets
+        :param manifest: LinkManifest instance
+        :param withdraw: if True, the manifest datasets absent from the queryset are withdrawn
+        :return: the queryset of datasets to process
+        """
+        known = manifest.datasets()
+        if not known:
+            self.stdout.write(self.style.SUCCESS('Empty manifest, processing all datasets'))
+            return datasets
+        public = set(map(str, datasets.values_list('id', flat=True)))
+        if withdraw and (withdrawn := known - public):
+            self.remove_links(manifest, withdrawn)
+        pending = public - known
+        if last_run := manifest.last_run():
+            pending.update(map(str, datasets.filter(auto_datetime__gt=last_run).values_list('id', flat=True)))
+        self.stdout.write(self.style.SUCCESS(f'{len(pending)} datasets added or modified since {last_run}'))
+        return datasets.filter(id__in=pending)
+
+    def remove_links(self, manifest, datasets):
+        """Remove the links of datasets and their manifest entries"""
+        links = manifest.links(datasets)
+        for link in links.values():
+            if os.path.islink(link):
+                os.unlink(link)
+        manifest.remove(datasets)
+        self.stdout.write(self.style.SUCCESS(f'Removed {len(links)} links of withdrawn datasets'))
+
+    def create_links_batched(self, file_records, workers=16, manifest=None):
+        """
+        Create the symlinks of the file records grouped by directory, using a pool of threads.
+
+        :param file_records: queryset of Flatiron file records to link
+        :param workers: number of directories processed concurrently
+        :param manifest: optional LinkManifest instance, where the links are recorded; the
+         previous links of the datasets whose path changed are removed
+        """
+        t0 = time.time()
+        directories = defaultdict(dict)
+        for fr in file_records.iterator():
+            rel_path = Path(fr.data_url.split('public')[1].strip('/'))
+            directories[rel_path.parent.as_posix()][rel_path.name] = fr.dataset_id
+
+        created = skipped = missing = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(link_directory, rel_dir, list(names)): rel_dir
+                       for rel_dir, names in directories.items()}
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures), unit='dir'):
+                n_created, n_skipped, missing_sources, linked = future.result()
+                created += n_created
+                skipped += n_skipped
+                missing += len(missing_sources)
+                for source in missing_sources:
+                    self.stdout.write(f'...source does not exist: {source}')
+                if manifest and linked:
+                    rel_dir = futures[future]
+                    links = [(directories[rel_dir][name], PUBLIC_ROOT.joinpath(rel_dir, name)) for name in linked]
+                    self.record_links(manifest, links)
+
+        elapsed = time.time() - t0
+        self.stdout.write(self.style.SUCCESS(
+            f'Summary: {created} symlinks created, {skipped} already existed, {missing} source files missing'
+        ))
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {len(directories)} directories in {elapsed:.0f} s ({created / max(elapsed, 1e-3):.0f} links/s)'
+        ))
+
+    @staticmethod
+    def record_links(manifest, links):
+        """Record links in the manifest, removing the previous links of the datasets that moved"""
+        previous = manifest.links(d for d, _ in links)
+        for dataset, link in links:
+            old_link = previous.get(str(dataset))
+            if old_link and old_link != str(link) and os.path.islink(old_link):
+                os.unlink(old_link)
+        manifest.record(links)
@@ -46,6 +46,14 @@ class Command(BaseCommand):
     python ./manage.py ibl paired_recordings
         Computes the latest version of the paired recording cache and uploads it to
          s3://[public_bucket]/caches/alyx
+
+    python ./manage.py ibl gallery_table
+        Creates or refreshes the materialised table of report plots metadata used by the
+         ibl_reports gallery
+
+    python ./manage.py ibl training_status
+        Recomputes the subjects training status timelines of the ibl_reports gallery, for the labs
+         whose subjects training status changed
     """
     def add_arguments(self, parser):
         parser.add_argument('action', help='Action')
@@ -100,5 +108,12 @@ class Command(BaseCommand):
                 lab, data_repository=repo, archive_date=date, nsessions=n, dry_run=dry)
         elif action == 'paired_recordings':
             compute_upload_paired_experiments_to_s3()
+        elif action == 'gallery_table':
+            # the reports app is only deployed alongside the main alyx instance
+            from ibl_reports.gallery import refresh_gallery_table
+            refresh_gallery_table()
+        elif action == 'training_status':
+            from ibl_reports.training_status import update_training_status
+            update_training_status()
         else:
             raise ValueError(f'No action for command {action}')
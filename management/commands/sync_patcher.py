@@ -18,7 +18,9 @@ The command has 2 modes: list, and sync.
 List the files to be synced and deleted: no action will be performed, log level can be set to DEBUG
 >>> python manage.py sync_patcher list
 >>> python manage.py sync_patcher list --verbosity 2
-Run in dry mode: this will still invoke AWS commands in dry mode, and no copy will occur
+Export the summary of the pending datasets per session and user, e.g. for monitoring
+>>> python manage.py sync_patcher list --parquet /home/datauser/ibl_logs/sync_patcher.pqt
+Run in dry mode: the transfers are only logged, AWS is not contacted and no record is updated
 >>> python manage.py sync_patcher sync --dryrun
 Run the synchronization
 >>> python manage.py sync_patcher sync > /home/datauser/ibl_logs/sync_patcher.log 2>&1
@@ -27,31 +29,100 @@ Force the overwrite of already existing files on flatiron (Run with extreme caut
 """
 
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dateutil.relativedelta import relativedelta as rd
-from subprocess import Popen, PIPE
 import logging
 from pathlib import Path
 
+import boto3
+import pandas as pd
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from one.alf.path import add_uuid_string
 from django.core.paginator import Paginator
-from django.core.management import BaseCommand
-from django.db.models import Count, Sum, Q
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum, Min, Exists, OuterRef, Prefetch
+from django.utils import timezone
 
 from data.models import DataRepository, Dataset, FileRecord
 import iblutil.util
 
-logger = iblutil.util.setup_logger(__name__)
-
+from ._ibl.s3_sync import local_etag
 
-def run_aws_command(cmd):
-    logger.debug(' '.join(cmd))
-    process = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        logger.error(stderr.decode('utf-8'))
-        raise RuntimeError(f'Command {" ".join(cmd)} failed with return code {process.returncode}')
-    else:
-        logger.debug(stdout.decode('utf-8'))
+logger = iblutil.util.setup_logger(__name__)
+AWS_PROFILE = 'ibladmin'
+PRIVATE_BUCKET = 'ibl-brain-wide-map-private'
+
+
+def create_transfer(profile=AWS_PROFILE, workers=8):
+    """
+    Create an S3 client and a transfer manager shared by the transfer workers
+    :param profile: The AWS profile of the credentials
+    :param workers: The number of datasets transferred concurrently
+    :return: The S3 client and the transfer manager
+    """
+    session = boto3.Session(profile_name=profile)
+    client = session.client('s3', config=Config(max_pool_connections=workers * 4))
+    transfer = create_transfer_manager(client, TransferConfig(max_concurrency=workers * 2))
+    return client, transfer
+
+
+def is_patcher_file(client, bucket, src_key, dst_file):
+    """
+    Whether a Flatiron file is the object of the S3 patcher, i.e. it has the same size and ETag.
+    The patcher objects are uploaded with the default multipart chunk size.
+
+    :return: False if the contents differ or if the patcher object does not exist
+    """
+    try:
+        head = client.head_object(Bucket=bucket, Key=src_key)
+    except ClientError:
+        return False
+    if head['ContentLength'] != Path(dst_file).stat().st_size:
+        return False
+    return local_etag(dst_file, TransferConfig().multipart_chunksize) == head['ETag'].strip('"')
+
+
+def transfer_dataset(client, transfer, bucket, src_key, dst_file, private_key=None, download=True, dry=False):
+    """
+    Download a dataset from the S3 patcher to Flatiron and, optionally, copy it server-side to the
+    private bucket.
+
+    :param client: The shared S3 client
+    :param transfer: The shared transfer manager
+    :param bucket: The S3 patcher bucket name
+    :param src_key: The key of the dataset in the S3 patcher bucket
+    :param dst_file: The Flatiron file path
+    :param private_key: If provided, the key of the dataset in the private bucket
+    :param download: If false, the file is already on Flatiron and is not downloaded again, provided
+     it is the patcher object
+    :param dry: If true, only log the operations
+    :return: True if the Flatiron file exists after the transfer, None if the existing Flatiron
+     file is not the patcher object and is left untouched
+    """
+    if not download and not is_patcher_file(client, bucket, src_key, dst_file):
+        return None
+    if download:
+        logger.debug(f'{"(dryrun) " if dry else ""}download: s3://{bucket}/{src_key} to {dst_file}')
+    if private_key:
+        logger.debug(f'{"(dryrun) " if dry else ""}copy: s3://{bucket}/{src_key} to s3://{PRIVATE_BUCKET}/{private_key}')
+    if dry:
+        return True
+    if download:
+        Path(dst_file).parent.mkdir(parents=True, exist_ok=True)
+        transfer.download(bucket, src_key, dst_file).result()
+    if not Path(dst_file).exists():
+        return False
+    if private_key:
+        transfer.copy({'Bucket': bucket, 'Key': src_key}, PRIVATE_BUCKET, private_key).result()
+    return True
+
+
+def find_record(file_records, repository):
+    """Return the first of the file records whose repository name contains a string, or None"""
+    return next((fr for fr in file_records if repository in fr.data_repository.name.lower()), None)
 
 
 def format_seconds(seconds):
@@ -81,6 +152,10 @@ class Command(BaseCommand):
         parser.add_argument('--dryrun', action='store_true',
                             help='Displays the operations that would be performed using the '
                                  'specified command without actually running them.')
+        parser.add_argument('-w', '--workers', default=8, type=int,
+                            help='Number of datasets transferred concurrently')
+        parser.add_argument('--parquet', default=None, type=str,
+                            help='Save the summary of the datasets to sync per session and user to this parquet file')
 
 
     def handle(self, *_, **options):
@@ -96,53 +171,70 @@ class Command(BaseCommand):
 
         dry = options.pop('dryrun')
         force = options.pop('force')
+        workers = options.pop('workers')
         t0 = time.time()
         # list the files to be synced
         query_paginated = self.build_sync_query(**options)
         # perform the sync if necessary
         if options.get('action') =='sync':
-            self.sync(query_paginated, force=force, dry=dry)
+            n_failed = self.sync(query_paginated, force=force, dry=dry, workers=workers)
             logger.info('Entire sync and update took ' + format_seconds(time.time() - t0))
+            if n_failed:
+                raise CommandError(f'{n_failed:,} dataset(s) failed to sync')
 
     @staticmethod
-    def log_dataset(qs):
-        # Aggregate qs per session: count and sum of filesize
-        session_stats = qs.values('session').annotate(
-            dataset_count=Count('id'),
-            total_size=Sum('file_size')
-        )
-        total_size = 0
-        for stat in session_stats:
-            logger.info(f"Session {stat['session']} : {stat['dataset_count']} datasets, "
-                        f"{stat['total_size'] / (1024 ** 3):.2f} GB total")
-            total_size += stat['total_size']
-        logger.info(f'{qs.count()} files are due to be processed, representing {total_size / (1024 ** 3):.2f} GB total')
-        if logger.isEnabledFor(logging.DEBUG):
-            for dset in qs:
-                logger.debug(f'{dset.session}, {dset}')
+    def log_dataset(qs, parquet=None):
+        """
+        Log the summary of the datasets to sync per session and user, computed in a single query.
 
+        :param qs: queryset of datasets to sync
+        :param parquet: optional file path where the summary is saved
+        :return: pandas.DataFrame with columns (session, lab, user, n_datasets, total_bytes,
+         oldest_pending)
+        """
+        columns = ('session', 'lab', 'user', 'n_datasets', 'total_bytes', 'oldest_pending')
+        summary = (qs
+                   .order_by()
+                   .values_list('session', 'session__lab__name', 'created_by__username')
+                   .annotate(n_datasets=Count('id'), total_bytes=Sum('file_size'),
+                             oldest_pending=Min('created_datetime')))
+        df = pd.DataFrame.from_records(summary, columns=columns)
+        df['session'] = df['session'].astype(str)
+        df['total_bytes'] = df['total_bytes'].fillna(0).astype('int64')
+        df = df.sort_values('oldest_pending', ignore_index=True)
+        for _, stat in df.iterrows():
+            logger.info(f"Session {stat['session']} ({stat['user']}): {stat['n_datasets']} datasets, "
+                        f"{stat['total_bytes'] / (1024 ** 3):.2f} GB total, oldest {stat['oldest_pending']}")
+        logger.info(f'{df["n_datasets"].sum()} files are due to be processed, '
+                    f'representing {df["total_bytes"].sum() / (1024 ** 3):.2f} GB total')
+        if parquet:
+            df.to_parquet(parquet)
+            logger.info(f'Summary saved to {parquet}')
+        return df
 
     @staticmethod
     def build_query(flat_iron_exists=False, **options) -> Paginator:
         """Build a paginated queryset of datasets to sync"""
         # Find datasets
         batch_size = options.pop('batch_size')
-        # Find all file records with a s3 patcher data repository
-        frs = FileRecord.objects.filter(data_repository__name='s3_patcher')
-        # Find the associated datasets
-        dsets = frs.values_list('dataset', flat=True)
-        # Find the flatiron file records for the specific datasets that have exists=False
+        # Datasets with a s3 patcher file record, and a flatiron file record with the given exists flag
+        patcher = FileRecord.objects.filter(dataset=OuterRef('pk'), data_repository__name='s3_patcher')
+        flatiron = FileRecord.objects.filter(dataset=OuterRef('pk'), data_repository__name__icontains='flatiron',
+                                             exists=flat_iron_exists)
         query_kwargs = {}
         if options.get('user'):
-            query_kwargs['dataset__created_by__username'] = options.get('user')
+            query_kwargs['created_by__username'] = options.get('user')
         if options.get('session'):
-            query_kwargs['dataset__session'] = options.get('session')
-        frs = FileRecord.objects.filter(dataset__in=dsets, data_repository__name__icontains='flatiron',
-                                        exists=flat_iron_exists, **query_kwargs)
+            query_kwargs['session'] = options.get('session')
+        qs = Dataset.objects.filter(Exists(patcher), Exists(flatiron), **query_kwargs)
+        # Summarise the datasets
+        Command.log_dataset(qs, parquet=options.get('parquet'))
         # Get the datasets that need to be synced
-        qs = Dataset.objects.filter(id__in=frs.values_list('dataset', flat=True)).order_by('session__start_time')
-        # Find datasets
-        Command.log_dataset(qs)
+        qs = (qs
+              .select_related('session__subject', 'session__lab', 'created_by')
+              .prefetch_related(Prefetch('file_records',
+                                         queryset=FileRecord.objects.select_related('data_repository')))
+              .order_by('session__start_time'))
         # Restrict to specific number of datasets
         limit = options.pop('limit')
         if limit:
@@ -157,78 +249,125 @@ class Command(BaseCommand):
 
 
     @staticmethod
-    def sync(paginated_query, force=False, dry=False):
+    def sync(paginated_query, force=False, dry=False, workers=8):
         """
 
         Sync the paginated query of datasets from aws s3_patcher bucket to flatiron
 
+        The datasets are transferred by a pool of workers sharing a single S3 client: each
+        dataset is downloaded to Flatiron and, if it has an AWS file record, copied server-side
+        from the patcher bucket to the private bucket. Once all the transfers of a page complete,
+        the file records of the page are updated in bulk, after which the datasets are removed from
+        the patcher.
+
         :param paginated_query: paginated query of datasets to sync
         :param force: whether to overwrite an existing dataset
-        :param dry: doesn't execute the actual aws sync commands
-        :return:
+        :param dry: doesn't execute the actual transfers
+        :param workers: the number of datasets transferred concurrently
+        :return: the number of datasets that failed to transfer
         """
 
         # S3 credential information
         r = DataRepository.objects.filter(name='s3_patcher').first()
         assert r
-        bucket_name = r.json['bucket_name']
-        if not bucket_name.startswith('s3:'):
-            bucket_name = 's3://' + bucket_name
+        bucket_name = r.json['bucket_name'].replace('s3://', '').strip('/')
 
         # Ugly hack because globus_path doesn't actually contain the correct absolute path
         ROOT = '/mnt/ibl'
         PATCHER_ROOT = '/patcher'
         t0 = time.time()
-
-        for i in paginated_query.page_range:
-            data = paginated_query.get_page(i)
-            current_qs = data.object_list
-
-            for dset in current_qs:
-                fr_flatiron = dset.file_records.get(dataset=dset, data_repository__name__icontains='flatiron')
-                lab_path = fr_flatiron.data_repository.globus_path
-                dset_path = str(add_uuid_string(fr_flatiron.relative_path, dset.id))
-                dst_file = ROOT + lab_path + dset_path
-                src_file = bucket_name + PATCHER_ROOT + lab_path + dset_path
-                if Path(dst_file).exists() and not force:
-                    logger.info(f'Destination file for {str(dset.id)} already exists and will not be overwritten, '
-                                f'set force=True to overwrite')
-                    continue
-                # Build up the aws command
-                cmd = ['aws', 's3', 'cp', src_file, dst_file, '--profile', 'ibladmin', '--no-progress']
-                if dry:
-                    cmd.append('--dryrun')
-                t0 = time.time()
-                logger.info(f'{dset.session}, {dset.collection}, {dset.name}, {dset.created_by.username}')
-                run_aws_command(cmd=cmd)
-                if not dry:
-                    exists = Path(dst_file).exists()
-                    # Update the file record
-                    if exists:
-                        logger.info(f'Updating flatiron file record for {str(dset.id)} to True')
-                        fr_flatiron.exists = True
-                        fr_flatiron.save()
-                        # If the aws file record exists upload the file from S3 patcher to S3 directly
-                        fr_aws = FileRecord.objects.filter(dataset=dset, data_repository__name__icontains='aws').first()
-                        if fr_aws is not None:
-                            file_s3_ibl = 's3://ibl-brain-wide-map-private/data' + lab_path + dset_path
-                            run_aws_command(cmd= ['aws', 's3', 'cp', src_file, file_s3_ibl, '--profile', 'ibladmin'])
-                            fr_aws.exists = True
-                            fr_aws.save()
-                        # this deletes the file records from the local servers and from the S3 patcher
-                        frs = dset.file_records.all().exclude(
-                            Q(data_repository__name__startswith='flatiron') |
-                            Q(data_repository__name__startswith='aws')
-                        )
-                        frs.delete()
-                        logger.debug(f'Deleting file records {frs.values_list("data_repository__name")}')
-                        # Delete the file from S3 patcher bucket
-                        run_aws_command(cmd= ['aws', 's3', 'rm', src_file, '--profile', 'ibladmin'])
-                        # Makes sure the last modified date is updated
-                        dset.save()
-                    else:
-                        logger.error(f'File for {str(dset.id)} was not transferred')
+        n_failed = 0
+
+        client, transfer = create_transfer(workers=workers)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i in paginated_query.page_range:
+                    data = paginated_query.get_page(i)
+                    current_qs = data.object_list
+
+                    futures = {}
+                    for dset in current_qs:
+                        # The file records and their repositories are prefetched with the page
+                        file_records = dset.file_records.all()
+                        fr_flatiron = find_record(file_records, 'flatiron')
+                        lab_path = fr_flatiron.data_repository.globus_path
+                        dset_path = str(add_uuid_string(fr_flatiron.relative_path, dset.id))
+                        dst_file = ROOT + lab_path + dset_path
+                        src_key = PATCHER_ROOT.strip('/') + lab_path + dset_path
+                        download = force or not Path(dst_file).exists()
+                        if not download and dry:
+                            logger.info(f'Destination file for {str(dset.id)} already exists and will not be overwritten, '
+                                        f'set force=True to overwrite')
+                            continue
+                        # Without force an existing file is only kept if it is the patcher object, i.e. a
+                        # previous run was interrupted after the download; the transfer worker checks it
+                        # If the aws file record exists the file is copied from S3 patcher to S3 directly
+                        fr_aws = find_record(file_records, 'aws')
+                        private_key = 'data' + lab_path + dset_path if fr_aws is not None else None
+                        logger.info(f'{dset.session}, {dset.collection}, {dset.name}, {dset.created_by.username}')
+                        future = executor.submit(transfer_dataset, client, transfer, bucket_name, src_key, dst_file,
+                                                 private_key=private_key, download=download, dry=dry)
+                        futures[future] = (dset, file_records, src_key)
+
+                    transferred, exists_ids, delete_ids, dataset_ids = [], [], [], []
+                    for future in as_completed(futures):
+                        dset, file_records, src_key = futures[future]
+                        try:
+                            exists = future.result()
+                        except Exception as ex:
+                            logger.error(f'Transfer of {str(dset.id)} failed: {ex}')
+                            n_failed += 1
+                            continue
+                        if dry:
+                            continue
+                        if exists is None:
+                            logger.info(f'Destination file for {str(dset.id)} already exists and will not be overwritten, '
+                                        f'set force=True to overwrite')
+                        elif exists:
+                            logger.info(f'Updating flatiron file record for {str(dset.id)} to True')
+                            exists_ids.extend(fr.id for fr in (find_record(file_records, 'flatiron'),
+                                                               find_record(file_records, 'aws')) if fr)
+                            # the file records from the local servers and from the S3 patcher are deleted
+                            frs = [fr for fr in file_records
+                                   if not fr.data_repository.name.startswith(('flatiron', 'aws'))]
+                            logger.debug(f'Deleting file records {[fr.data_repository.name for fr in frs]}')
+                            delete_ids.extend(fr.id for fr in frs)
+                            dataset_ids.append(dset.id)
+                            transferred.append(src_key)
+                        else:
+                            logger.error(f'File for {str(dset.id)} was not transferred')
+                            n_failed += 1
+
+                    # Update the file records of the page, then delete the files from S3 patcher bucket
+                    Command.update_records(exists_ids, delete_ids, dataset_ids)
+                    Command.delete_from_patcher(client, bucket_name, transferred)
+        finally:
+            transfer.shutdown()
 
         logger.debug('Datasets sync took ' + format_seconds(time.time() - t0))
+        return n_failed
 
+    @staticmethod
+    def update_records(exists_ids, delete_ids, dataset_ids):
+        """
+        Update in bulk the records of the datasets synced
+        :param exists_ids: ids of the file records to set as existing
+        :param delete_ids: ids of the file records to delete
+        :param dataset_ids: ids of the datasets whose last modified date is updated
+        """
+        if not dataset_ids:
+            return
+        with transaction.atomic():
+            FileRecord.objects.filter(pk__in=exists_ids).update(exists=True)
+            FileRecord.objects.filter(pk__in=delete_ids).delete()
+            # Makes sure the last modified date is updated
+            Dataset.objects.filter(pk__in=dataset_ids).update(auto_datetime=timezone.now())
 
+    @staticmethod
+    def delete_from_patcher(client, bucket_name, keys):
+        """Delete objects from the S3 patcher bucket, in batches of 1000"""
+        for i in range(0, len(keys), 1000):
+            response = client.delete_objects(
+                Bucket=bucket_name, Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.error(f'Failed to delete s3://{bucket_name}/{error["Key"]}: {error["Message"]}')
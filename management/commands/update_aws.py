@@ -1,30 +1,144 @@
 """Script to query recently-updated datasets and sync those specific sessions with AWS.
 Currently expected to run on SDSC with access to /mnt/ibl Flatiron directory.
 """
+import os
+import re
+import sqlite3
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dateutil.relativedelta import relativedelta as rd
-from subprocess import Popen, PIPE, STDOUT
 import logging
 import uuid
 from pathlib import Path
-from functools import partial
 
 from one.alf.path import folder_parts, get_session_path, get_alf_path, add_uuid_string
 import pandas as pd
+from django.db import transaction
 from django.db.models import Q, OuterRef
 from django.core.paginator import Paginator
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
-from data.models import DataRepository, Dataset, FileRecord
+from data.models import DataRepository, FileRecord
+from ._ibl.s3_sync import S3Sync
 
 logger = logging.getLogger('data.transfers').getChild('aws')
-sync_times_file = Path.home().joinpath('Documents', '.aws_sync.csv')
+sync_times_file = Path.home().joinpath('Documents', '.aws_sync.csv')  # legacy, imported in the journal
+sync_journal_file = Path.home().joinpath('Documents', '.aws_sync.sqlite')
+AWS_PROFILE = 'ibladmin'
 
 
-def log_subprocess_output(pipe, log_function=logger.info):
-    for line in iter(pipe.readline, b''):
-        log_function(line.decode().strip())
+def format_bytes(n_bytes):
+    """Represent a number of bytes in the largest unit in which it is at least 1"""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(n_bytes) < 1024 or unit == 'TB':
+            return f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1024
+
+
+def parse_bandwidth(bandwidth):
+    """
+    Parse a bandwidth in the AWS CLI format, i.e. an integer number of bytes per second or a
+    string such as '50MB/s', into an integer number of bytes per second
+    """
+    units = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    if not (match := re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?B)?(?:/s)?', str(bandwidth).strip(), re.I)):
+        raise ValueError(f'Invalid bandwidth "{bandwidth}"')
+    return int(float(match.group(1)) * units[(match.group(2) or 'B').upper()])
+
+
+def sync_session(engine, src_dir, prefix, dry=False, files=None, delete=False):
+    """
+    Sync a local session folder with AWS S3. When all the files of the session are synced, the
+    objects absent locally are deleted; when only some files are, the other objects are only
+    deleted if `delete` is true.
+
+    :param engine: The S3Sync instance shared by the sessions
+    :param src_dir: The local session path
+    :param prefix: The S3 prefix of the session
+    :param dry: If true, only log the operations that would be performed
+    :param files: If provided, only these files, relative to the session path, are compared and
+     uploaded, otherwise all the files of the session
+    :param delete: If true and files are provided, the whole session prefix is listed to delete
+     the objects absent locally
+    :return: The SyncResult and the duration of the sync in seconds
+    :raises FileNotFoundError: If the local session folder does not exist, in which case the
+     session is counted as failed and nothing is deleted
+    """
+    t0 = time.time()
+    if files is None:
+        result = engine.sync(src_dir, prefix, delete=True, dry=dry)
+    else:
+        result = engine.sync_files(src_dir, prefix, files, delete=delete, dry=dry)
+    return result, time.time() - t0
+
+
+class SyncJournal:
+    """
+    Durable journal of the AWS syncs, stored in a SQLite database.
+
+    It records the start and end times of the runs, and, for each session, the dataset
+    modification time up to which the session was synced. The session checkpoints are committed
+    as soon as a session is synced, so that an interrupted run can be resumed by skipping the
+    sessions already synced.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = Path(filepath or sync_journal_file)
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(self.filepath)
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS runs '
+                             '(id INTEGER PRIMARY KEY, start TEXT NOT NULL, end TEXT)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS sessions '
+                             '(eid TEXT PRIMARY KEY, synced_until TEXT NOT NULL, synced_at TEXT NOT NULL)')
+        if self.con.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 0 and sync_times_file.exists():
+            self._import_csv(sync_times_file)
+
+    def _import_csv(self, filepath):
+        """Import the runs of the legacy sync times CSV file"""
+        syncs = pd.read_csv(filepath, parse_dates=[0, 1])
+        with self.con:
+            self.con.executemany('INSERT INTO runs (start, end) VALUES (?, ?)', [
+                (start.isoformat(), None if pd.isna(end) else end.isoformat())
+                for start, end in syncs[['start', 'end']].itertuples(index=False)])
+
+    def runs(self):
+        """Return a dataframe of the start and end times of the runs"""
+        runs = self.con.execute('SELECT start, end FROM runs ORDER BY id').fetchall()
+        runs = pd.DataFrame(runs, columns=('start', 'end'), dtype=object)
+        return runs.apply(pd.to_datetime, format='ISO8601')
+
+    def start_run(self):
+        """Record the start of a run and return its id"""
+        with self.con:
+            cursor = self.con.execute('INSERT INTO runs (start) VALUES (?)', (pd.Timestamp.now().isoformat(),))
+        return cursor.lastrowid
+
+    def end_run(self, run_id):
+        """Record the end of a complete run"""
+        with self.con:
+            self.con.execute('UPDATE runs SET end = ? WHERE id = ?', (pd.Timestamp.now().isoformat(), run_id))
+
+    def synced_until(self, eids):
+        """Return a map of session eid to the dataset modification time it was synced up to"""
+        eids = [str(eid) for eid in eids]
+        synced = {}
+        for i in range(0, len(eids), 500):  # SQLite limits the number of parameters
+            chunk = eids[i:i + 500]
+            query = f'SELECT eid, synced_until FROM sessions WHERE eid IN ({",".join("?" * len(chunk))})'
+            synced.update((eid, pd.Timestamp(t)) for eid, t in self.con.execute(query, chunk))
+        return synced
+
+    def checkpoint(self, eid, synced_until):
+        """Record that a session was synced up to a dataset modification time"""
+        with self.con:
+            self.con.execute(
+                'INSERT OR REPLACE INTO sessions (eid, synced_until, synced_at) VALUES (?, ?, ?)',
+                (str(eid), pd.Timestamp(synced_until).isoformat(), pd.Timestamp.now().isoformat()))
+
+    def close(self):
+        self.con.close()
 
 
 def format_seconds(seconds):
@@ -62,6 +176,18 @@ class Command(BaseCommand):
                             'specified command without actually running them.')
         parser.add_argument('-f', '--force', action='store_true',
                             help='Sync even if file records indicate files are already on AWS.')
+        parser.add_argument('--mode', choices=('session', 'dataset'), default='session',
+                            help='Either compare and upload all the files of the sessions and delete '
+                                 'the objects absent locally, or only compare and upload the files '
+                                 'of the queried datasets, deleting the objects absent locally only '
+                                 'for the sessions with queried datasets missing locally')
+        parser.add_argument('-w', '--workers', default=4, type=int,
+                            help='Number of sessions synced concurrently')
+        parser.add_argument('--max-concurrency', default=10, type=int,
+                            help='Number of concurrent file part uploads, shared by the workers')
+        parser.add_argument('--max-bandwidth', type=str,
+                            help='Total bandwidth cap shared by the workers, in bytes per second, '
+                                 'e.g. 100MB/s')
 
     def handle(self, *_, **options):
         # TODO Check logging works from outside main Alyx package
@@ -75,20 +201,30 @@ class Command(BaseCommand):
         required = ('hours', 'from_date', 'session', 'dataset', 'since_last')
         if not any(passed := list(map(options.get, required))):
             options['since_last'] = True
+        # Sessions already synced up to their latest dataset are skipped, unless forced
+        resume = not any(map(options.get, ('force', 'session', 'dataset')))
         dry = options.pop('dryrun')
+        workers = options.pop('workers')
+        mode = options.pop('mode')
+        max_concurrency = options.pop('max_concurrency')
+        max_bandwidth = options.pop('max_bandwidth')
         t0 = time.time()
         query_paginated = self.build_query(**options)
-        self.sync(query_paginated, dry=dry, save_sync_times=options.get('since_last', False))
+        counts = self.sync(query_paginated, dry=dry, save_sync_times=options.get('since_last', False),
+                           workers=workers, max_concurrency=max_concurrency, max_bandwidth=max_bandwidth,
+                           resume=resume, mode=mode)
         logger.debug('Entire sync and update took ' + format_seconds(time.time() - t0))
+        if counts['failed']:
+            raise CommandError(f'{counts["failed"]:,} session(s) failed to sync')
 
     @staticmethod
     def last_sync(filepath=None):
         """Load sync times history"""
-        sync_times = filepath or sync_times_file
-        loader = partial(pd.read_csv, parse_dates=[0, 1])
-        if not sync_times.exists() or (syncs := loader(sync_times)).empty:
-            syncs = pd.DataFrame(columns=('start', 'end'))
-        return syncs
+        journal = SyncJournal(filepath)
+        try:
+            return journal.runs()
+        finally:
+            journal.close()
 
     @staticmethod
     def build_query(**options) -> Paginator:
@@ -116,10 +252,11 @@ class Command(BaseCommand):
                 query.add(Q(dataset__auto_datetime__gt=v), Q.OR)
             elif k == 'since_last':
                 sync_times = Command.last_sync()
-                if sync_times.empty:
+                complete = sync_times.loc[~sync_times.end.isna(), 'start']
+                if complete.empty:
                     last_sync = pd.Timestamp.now() - pd.Timedelta(weeks=2)
                 else:
-                    last_sync = sync_times.loc[~sync_times.end.isna(), 'start'].iloc[-1]
+                    last_sync = complete.iloc[-1]
                 query.add(Q(dataset__auto_datetime__gt=last_sync.floor(freq='min')), Q.OR)
             else:
                 raise ValueError(f'Unknown kwarg "{k}"')
@@ -142,99 +279,171 @@ class Command(BaseCommand):
         return Paginator(qs, batch_size)
 
     @staticmethod
-    def sync(paginated_query, dry=False, save_sync_times=False):
+    def sync(paginated_query, dry=False, save_sync_times=False, workers=4, max_concurrency=10,
+             max_bandwidth=None, resume=True, mode='session'):
+        """
+        Sync the sessions of the file records with AWS and update the AWS file records.
+
+        The sessions are synced concurrently by a pool of workers sharing a single S3 client and
+        transfer manager. A session that fails to sync is logged and its file records are left
+        untouched; the sync times are only marked as complete when all sessions succeeded, so
+        that the next run retries them. Each synced session is checkpointed in the sync journal
+        with the latest modification time of its datasets.
+
+        :param paginated_query: Paginated file records, as returned by Command.build_query
+        :param dry: If true, display the operations without syncing nor updating the records
+        :param save_sync_times: If true, record the start and end times of the sync
+        :param workers: The number of sessions synced concurrently
+        :param max_concurrency: The number of concurrent file part uploads
+        :param max_bandwidth: The total bandwidth cap, e.g. '100MB/s'
+        :param resume: If true, skip the sessions checkpointed as synced up to their latest dataset
+        :param mode: If 'session', all the files of the sessions are compared and uploaded, and the
+         objects absent locally deleted; if 'dataset', only the files of the queried datasets are
+         compared and uploaded, listing only their folders; the deletions of a session are only
+         reconciled when some of its queried datasets are missing locally
+        :return: dict of counts of files, sessions, records added and modified, failed sessions
+        """
         # S3 credential information
         r = DataRepository.objects.filter(name__startswith='aws').first()
         assert r
         bucket_name = r.json['bucket_name']
-        if not bucket_name.startswith('s3:'):
-            bucket_name = 's3://' + bucket_name
 
-        # Sync times
-        sync_times = Command.last_sync()
-        sync_times.loc[len(sync_times)] = [started := pd.Timestamp.now(), pd.NaT]
-        if save_sync_times and not dry:
-            sync_times.to_csv(sync_times_file, index=False)
+        # Sync times and session checkpoints
+        journal = SyncJournal()
+        run_id = journal.start_run() if save_sync_times and not dry else None
+
+        engine = S3Sync(bucket_name, profile=AWS_PROFILE, max_concurrency=max_concurrency,
+                        max_bandwidth=parse_bandwidth(max_bandwidth) if max_bandwidth else None)
 
         # Ugly hack because globus_path doesn't actually contain the correct absolute path
         ROOT = '/mnt/ibl'  # This should be in the globus_path but isn't
-        counts = {'total': 0, 'added': 0, 'modified': 0, 'sessions': 0}
-        for i in paginated_query.page_range:
-            data = paginated_query.get_page(i)
-            current_qs = data.object_list
-            df = pd.DataFrame.from_records(current_qs)
-            if df.empty:
-                logger.debug('No file records to process')
-                continue
-            logger.info(f'Processing {len(df)} records (batch {i}/{paginated_query.num_pages})')
-            df['file_path'] = df.pop('data_repository__globus_path').str.cat(df.pop('relative_path'))
-            fields_map = {
-                'dataset__session': 'eid',
-                'dataset__id': 'id',
-                'dataset__auto_datetime': 'modified'}
-            df = df.rename(fields_map, axis=1).set_index('eid')
-            counts['total'] += len(df)
-            # Sync is done and the session level
-            for eid, rec in df.groupby('eid'):
-                logger.info(f'Updating session {eid}')
-                counts['sessions'] += 1
-                session_path = next(map(get_session_path, rec['file_path'].values))
-                src_dir = ROOT + session_path.as_posix()
-                dst_dir = bucket_name.strip('/') + '/data/' + get_alf_path(src_dir)
-                cmd = ['aws', 's3', 'sync', src_dir, dst_dir, '--delete', '--profile', 'ibladmin']
-                if dry:
-                    cmd.append('--dryrun')
-                if logger.level > logging.DEBUG:
-                    log_fcn = logger.error
-                    cmd.append('--only-show-errors')  # Suppress verbose output
-                else:
-                    log_fcn = logger.debug
-                    cmd.append('--no-progress')  # Suppress progress info, estimated time, etc.
-                logger.debug(' '.join(cmd))
-                t0 = time.time()
-                process = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-                with process.stdout:
-                    log_subprocess_output(process.stdout, log_fcn)
-                assert process.wait() == 0
-                logger.debug('Session sync took ' + format_seconds(time.time() - t0))
-
-                # Update file records
-                lab, *_ = folder_parts(session_path)
-                repo = f'aws_{lab}'
-                for _, row in rec.iterrows():
-                    record = {
-                        'dataset': Dataset.objects.get(id=row['id']),
-                        'data_repository': DataRepository.objects.get(name=repo),
-                        'relative_path': row['file_path'].replace(f'{lab}/Subjects', '').strip('/')
-                    }
-                    # Check the real file path - WITH uuid in filename - exists
-                    exists = add_uuid_string(ROOT + row['file_path'], row['id']).exists()
-                    if dry:
+        counts = {'total': 0, 'added': 0, 'modified': 0, 'sessions': 0, 'failed': 0, 'bytes': 0,
+                  'skipped': 0}
+        failed = []
+        t_start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i in paginated_query.page_range:
+                    data = paginated_query.get_page(i)
+                    current_qs = data.object_list
+                    df = pd.DataFrame.from_records(current_qs)
+                    if df.empty:
+                        logger.debug('No file records to process')
+                        continue
+                    logger.info(f'Processing {len(df)} records (batch {i}/{paginated_query.num_pages})')
+                    df['file_path'] = df.pop('data_repository__globus_path').str.cat(df.pop('relative_path'))
+                    fields_map = {
+                        'dataset__session': 'eid',
+                        'dataset__id': 'id',
+                        'dataset__auto_datetime': 'modified'}
+                    df = df.rename(fields_map, axis=1).set_index('eid')
+                    # Sync is done at the session level, by a pool of workers
+                    futures = {}
+                    synced = journal.synced_until(df.index.unique()) if resume else {}
+                    for eid, rec in df.groupby('eid'):
+                        if str(eid) in synced and synced[str(eid)] >= pd.Timestamp(rec['modified'].max()):
+                            logger.debug(f'Skipping session {eid}: already synced')
+                            counts['skipped'] += 1
+                            continue
+                        session_path = next(map(get_session_path, rec['file_path'].values))
+                        src_dir = ROOT + session_path.as_posix()
+                        prefix = 'data/' + get_alf_path(src_dir)
+                        files, delete = None, False
+                        if mode == 'dataset':  # the real file names - WITH uuid
+                            files = [add_uuid_string(ROOT + file_path, dataset_id).relative_to(src_dir).as_posix()
+                                     for dataset_id, file_path in zip(rec['id'], rec['file_path'])]
+                            exists = [Path(src_dir, f).exists() for f in files]
+                            # Datasets missing locally were deleted or renamed: their objects are
+                            # removed by reconciling the deletions of the whole session
+                            delete = not all(exists)
+                            files = [f for f, e in zip(files, exists) if e]
+                        future = executor.submit(sync_session, engine, src_dir, prefix, dry=dry, files=files,
+                                                 delete=delete)
+                        futures[future] = (eid, session_path, rec)
+                    # The file records are updated from this thread as the syncs complete
+                    for future in as_completed(futures):
+                        eid, session_path, rec = futures[future]
                         try:
-                            fr = FileRecord.objects.get(**record)
-                            if fr.exists != exists:
-                                counts['modified'] += 1
-                                logger.info(f'(dryrun) MODIFIED: {fr.relative_path}; EXISTS = {exists}')
-                        except FileRecord.DoesNotExist:
-                            counts['added'] += 1
-                            logger.info('(dryrun) ADDED: ' + record['relative_path'])
-                    else:
-                        fr, is_new = FileRecord.objects.get_or_create(**record)
-                        if is_new:
-                            counts['added'] += 1
-                            logger.info(f'ADDED: {fr.relative_path}')
-                        elif fr.exists != exists:
-                            counts['modified'] += 1
-                            logger.info(f'MODIFIED: {fr.relative_path}; EXISTS = {exists}')
-                            fr.exists = exists
-                        fr.full_clean()
-                        fr.save()
+                            result, duration = future.result()
+                        except Exception as ex:
+                            logger.error(f'Failed to sync session {eid}: {ex}')
+                            failed.append(eid)
+                            continue
+                        logger.info(f'Updated session {eid} in {format_seconds(duration) or "0 seconds"}: '
+                                    f'{len(result.uploaded)} uploaded, {len(result.deleted)} deleted')
+                        counts['sessions'] += 1
+                        counts['total'] += len(rec)
+                        counts['bytes'] += result.bytes
+                        Command.update_file_records(rec, session_path, counts, dry=dry, root=ROOT)
+                        if not dry:
+                            journal.checkpoint(eid, rec['modified'].max())
+        finally:
+            engine.shutdown()
+        counts['failed'] = len(failed)
+        elapsed = time.time() - t_start
         logger.info('{total:,} files over {sessions:,} sessions sync\'d; '
-                    '{added:,} records added, {modified:,} modified'.format(**counts))
-        if save_sync_times and not dry:  # set end time
-            sync_times = Command.last_sync()
-            sync_times.loc[sync_times.start == started, 'end'] = pd.Timestamp.now()
-            sync_times.to_csv(sync_times_file, index=False)
+                    '{added:,} records added, {modified:,} modified; '
+                    '{skipped:,} sessions already synced'.format(**counts))
+        logger.info(f'Synced {format_bytes(counts["bytes"])} in {format_seconds(elapsed) or "0 seconds"} '
+                    f'({format_bytes(counts["bytes"] / max(elapsed, 1e-3))}/s, '
+                    f'{counts["sessions"] / max(elapsed, 1e-3) * 60:.1f} sessions/min)')
+        if failed:
+            logger.error(f'{len(failed):,} session(s) failed to sync: ' + ', '.join(map(str, failed)))
+        elif run_id is not None:  # set end time
+            journal.end_run(run_id)
+        journal.close()
+        return counts
+
+    @staticmethod
+    def update_file_records(rec, session_path, counts, dry=False, root='/mnt/ibl'):
+        """
+        Create or update the AWS file records of the datasets of a synced session.
+
+        The existing records are fetched in a single query and the new and modified records are
+        written in bulk, in a single transaction.
+
+        :param rec: The file records of the session, indexed by eid, with columns id, file_path
+        :param session_path: The session path, starting with the lab
+        :param counts: The dict of counts, updated with the records added and modified
+        :param dry: If true, log the changes without saving them
+        :param root: The local root of the file paths
+        """
+        lab, *_ = folder_parts(session_path)
+        repo = DataRepository.objects.get(name=f'aws_{lab}')
+        # Check the real file paths - WITH uuid in filename - exist, listing each of their folders once
+        file_paths = [add_uuid_string(root + file_path, dataset_id)
+                      for dataset_id, file_path in zip(rec['id'], rec['file_path'])]
+        on_disk = set()
+        for folder in {p.parent for p in file_paths}:
+            if folder.is_dir():
+                on_disk.update(folder.joinpath(name).as_posix() for name in os.listdir(folder))
+        existing = {
+            (fr.dataset_id, fr.relative_path): fr for fr in
+            FileRecord.objects.filter(data_repository=repo, dataset__in=rec['id'].unique().tolist())
+        }
+        new, modified = [], []
+        for dataset_id, file_path, real_path in zip(rec['id'], rec['file_path'], file_paths):
+            relative_path = file_path.replace(f'{lab}/Subjects', '').strip('/')
+            exists = real_path.as_posix() in on_disk
+            key = (uuid.UUID(str(dataset_id)), relative_path)
+            fr = existing.get(key)
+            if fr is None:
+                fr = existing[key] = FileRecord(dataset_id=dataset_id, data_repository=repo,
+                                                relative_path=relative_path, exists=exists)
+                fr.full_clean(exclude=['dataset', 'data_repository'], validate_unique=False)
+                new.append(fr)
+                logger.info(f'{"(dryrun) " if dry else ""}ADDED: {relative_path}')
+            elif fr.exists != exists:
+                fr.exists = exists
+                modified.append(fr)
+                logger.info(f'{"(dryrun) " if dry else ""}MODIFIED: {relative_path}; EXISTS = {exists}')
+        counts['added'] += len(new)
+        counts['modified'] += len(modified)
+        if dry or not (new or modified):
+            return
+        with transaction.atomic():
+            FileRecord.objects.bulk_create(new)
+            FileRecord.objects.bulk_update(modified, ['exists'])
 
 
 # def sync_changed():
@@ -0,0 +1,77 @@
+"""
+Cached choice lists of the ibl_reports filters.
+
+The filters are instantiated on every page load and their choice lists are built from the
+database. The lists are cached with the default django cache and invalidated when an instance
+of the model they are built from is saved or deleted. The timeout bounds the staleness of the
+lists when the change happens in a process where the invalidation signals are not connected.
+"""
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+from misc.models import Note, Lab
+from subjects.models import Project
+
+from ibl_reports.gallery import REPORT_TAG
+
+CACHE_TIMEOUT = 60 * 10
+
+
+def cached_choices(name, *senders, condition=None, timeout=CACHE_TIMEOUT):
+    """
+    Decorator caching the choice list returned by a function
+    :param name: name of the choice list, used in the cache key
+    :param senders: models whose save and delete signals invalidate the cached list
+    :param condition: optional function of the saved or deleted instance, returning True if the
+     cached list needs to be invalidated
+    :param timeout: cache timeout in seconds
+    :return: function returning the choice list, with an `invalidate` method
+    """
+    key = f'ibl_reports:choices:{name}'
+
+    def decorator(func):
+        def get_choices():
+            choices = cache.get(key)
+            if choices is None:
+                choices = list(func())
+                cache.set(key, choices, timeout)
+            return choices
+
+        def invalidate(sender=None, instance=None, **kwargs):
+            if condition is None or instance is None or condition(instance):
+                cache.delete(key)
+
+        for sender in senders:
+            uid = f'{key}:{sender._meta.label}'
+            post_save.connect(invalidate, sender=sender, weak=False, dispatch_uid=uid)
+            post_delete.connect(invalidate, sender=sender, weak=False, dispatch_uid=uid)
+        get_choices.invalidate = invalidate
+        get_choices.__name__ = func.__name__
+        get_choices.__doc__ = func.__doc__
+        return get_choices
+
+    return decorator
+
+
+def _is_report(note):
+    return isinstance(note.json, dict) and note.json.get('tag') == REPORT_TAG
+
+
+@cached_choices('labs', Lab)
+def lab_choices():
+    """(name, name) of all labs"""
+    return ((name, name) for name in Lab.objects.order_by('name').values_list('name', flat=True))
+
+
+@cached_choices('projects', Project)
+def project_choices():
+    """(name, name) of all projects"""
+    return ((name, name) for name in Project.objects.order_by('name').values_list('name', flat=True))
+
+
+@cached_choices('plot_types', Note, condition=_is_report)
+def plot_type_choices():
+    """(text, text) of the distinct plot types of the report notes"""
+    plot_types = (Note.objects.filter(json__tag=REPORT_TAG)
+                  .order_by('text').values_list('text', flat=True).distinct())
+    return ((text, text) for text in plot_types)
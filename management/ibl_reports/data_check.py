@@ -1,51 +1,75 @@
 import ibl_reports.data_info as expected_data
 from copy import deepcopy
 
+from django.db.models import Count, OuterRef, Subquery, Value, CharField, IntegerField
+from django.db.models.functions import Coalesce, Concat
+
+from data.models import Dataset
+
+
+class DatasetIndex:
+    """
+    In-memory index of a session's datasets, fetched in a single query.
+
+    Only the dataset type, collection and name of each dataset are loaded, in the same order as
+    the queryset, so that the expected dataset checks can be evaluated without further queries.
+    """
+
+    def __init__(self, datasets):
+        qs = datasets.all()
+        if not qs.ordered:
+            qs = qs.order_by('pk')  # same order as QuerySet.first
+        self.records = list(qs.values_list('dataset_type__name', 'collection', 'name'))
+        self._by_type = {}
+        for record in self.records:
+            self._by_type.setdefault(record[:2], []).append(record)
+
+    def first(self, dataset_type, collection, name_icontains=None):
+        """Return the first (type, collection, name) record matching, or None."""
+        for record in self._by_type.get((dataset_type, collection), []):
+            if name_icontains is None or name_icontains.lower() in record[2].lower():
+                return record
+
+    def count(self, collection=None, collection_icontains=None, name_icontains=None):
+        """Return the number of datasets matching all the provided criteria."""
+        n = 0
+        for _, coll, name in self.records:
+            if collection is not None and coll != collection:
+                continue
+            if collection_icontains is not None and collection_icontains.lower() not in (coll or '').lower():
+                continue
+            if name_icontains is not None and name_icontains.lower() not in name.lower():
+                continue
+            n += 1
+        return n
+
+
+def dataset_index(datasets):
+    """Return a DatasetIndex for a datasets queryset or related manager."""
+    return datasets if isinstance(datasets, DatasetIndex) else DatasetIndex(datasets)
+
+
+def _dataset_status(dsets, dset_type, collection, required, name_icontains=None):
+    record = dsets.first(dset_type, collection, name_icontains)
+    if record:
+        return {'collection': record[1], 'name': record[2], 'status': True}, False
+    return {'name': '-', 'collection': collection, 'status': False}, required
+
 
 def get_data_status(dsets, exp_dsets, title):
+    dsets = dataset_index(dsets)
     datasets = []
     n_dsets = 0
     n_exp_dsets = 0
     missing = False
 
     for dset in exp_dsets:
-        if len(dset) == 4:
-            for extra in dset[3]:
-                dset_data = {}
-                d = dsets.filter(dataset_type__name=dset[0], collection=dset[1],
-                                 name__icontains=extra)
-                dset_data['type'] = dset[0] + ' - ' + extra.upper()
-                if d.count() > 0:
-                    d = d.first()
-                    dset_data['collection'] = d.collection
-                    dset_data['name'] = d.name
-                    dset_data['status'] = True
-                    n_dsets += 1
-                else:
-                    if dset[2]:
-                        missing = True
-                    dset_data['name'] = '-'
-                    dset_data['collection'] = dset[1]
-                    dset_data['status'] = False
-                n_exp_dsets += 1
-                datasets.append(dset_data)
-
-        else:
-            dset_data = {}
-            d = dsets.filter(dataset_type__name=dset[0], collection=dset[1])
-            dset_data['type'] = dset[0]
-            if d.count() > 0:
-                d = d.first()
-                dset_data['name'] = d.name
-                dset_data['collection'] = d.collection
-                dset_data['status'] = True
-                n_dsets += 1
-            else:
-                if dset[2]:
-                    missing = True
-                dset_data['name'] = '-'
-                dset_data['collection'] = dset[1]
-                dset_data['status'] = False
+        extras = dset[3] if len(dset) == 4 else [None]
+        for extra in extras:
+            dset_data, critical = _dataset_status(dsets, dset[0], dset[1], dset[2], extra)
+            dset_data['type'] = dset[0] if extra is None else dset[0] + ' - ' + extra.upper()
+            n_dsets += dset_data['status']
+            missing |= critical
             n_exp_dsets += 1
             datasets.append(dset_data)
 
@@ -59,14 +83,11 @@ def get_data_status(dsets, exp_dsets, title):
 
 
 def get_tasks(expected_tasks, session):
+    # Iterate over all() so that tasks prefetched with the session are not fetched again
+    tasks = sorted(session.tasks.all(), key=lambda t: t.pk)  # same order as QuerySet.first
     task_status = {}
     for task in expected_tasks:
-        t = session.tasks.filter(name__icontains=task)
-
-        if t.count() > 0:
-            task_status[task] = t.first()
-        else:
-            task_status[task] = None
+        task_status[task] = next((t for t in tasks if task.lower() in t.name.lower()), None)
 
     return task_status
 
@@ -79,7 +100,7 @@ def get_probe_type(datasets, probe):
     if not probe_model:
         # in this case try and figure out from data structure, 3A probes have no data in
         # raw_ephys_data collection
-        dsets = datasets.filter(collection='raw_ephys_data').count()
+        dsets = dataset_index(datasets).count(collection='raw_ephys_data')
         probe_type = 'Neuropixel 3A' if dsets == 0 else 'Neuropixel 3B2'
     else:
         probe_type = probe_model.name
@@ -190,7 +211,7 @@ def dlc_data_status(datasets, session):
 
 def raw_video_data_status(datasets, session):
 
-    if datasets.filter(name__icontains='Camera.frameData.bin').count() > 0:
+    if dataset_index(datasets).count(name_icontains='Camera.frameData.bin') > 0:
         expected_dsets = expected_data.RAW_VIDEO + expected_data.RAW_VIDEO_NEW
     else:
         expected_dsets = expected_data.RAW_VIDEO + expected_data.RAW_VIDEO_OLD
@@ -213,7 +234,7 @@ def spikesort_data_status(datasets, session, probes):
     expected_both_dsets = []
     for probe in probes:
         expected_dsets = deepcopy(expected_data.SPIKE_SORTING)
-        if datasets.filter(collection__icontains=f'alf/{probe.name}/pykilosort').count() > 0:
+        if dataset_index(datasets).count(collection_icontains=f'alf/{probe.name}/pykilosort') > 0:
             for dset in expected_dsets:
                 dset[1] = f'alf/{probe.name}/pykilosort'
         else:
@@ -228,43 +249,61 @@ def spikesort_data_status(datasets, session, probes):
     return data
 
 
-def get_data_status_qs(probe_insertions):
+def _critical_datasets():
+    critical_behav_a = ['trials.table']
+    critical_behav_b = [dset[0] for dset in expected_data.TRIALS if dset[2]]
+    critical_spikesort = [dset[0] for dset in expected_data.SPIKE_SORTING if dset[2]]
+    critical_passive = [dset[0] for dset in (expected_data.PASSIVE + expected_data.RAW_PASSIVE) if dset[2]]
+    critical_video = [dset[0] for dset in (expected_data.VIDEO + expected_data.RAW_VIDEO) if dset[2]]
+    return critical_behav_a, critical_behav_b, critical_spikesort, critical_passive, critical_video
+
+
+def _session_dataset_count(**filters):
+    datasets = (Dataset.objects.filter(session=OuterRef('session'), **filters)
+                .order_by().values('session').annotate(n=Count('pk')).values('n'))
+    return Coalesce(Subquery(datasets, output_field=IntegerField()), 0)
+
+
+def annotate_data_status(probe_insertions):
+    """
+    Annotates a probe insertion queryset with the counts of critical datasets of their session
+    needed by get_data_status_qs. The counts are correlated subqueries, only evaluated for the
+    rows fetched.
+    """
+    behav_a, behav_b, spikesort, passive, video = _critical_datasets()
+    return probe_insertions.annotate(
+        n_behav_a=_session_dataset_count(collection__in=['alf'], dataset_type__name__in=behav_a),
+        n_behav_b=_session_dataset_count(collection__in=['alf'], dataset_type__name__in=behav_b),
+        n_spikesort=_session_dataset_count(
+            collection__icontains=Concat(Value('alf/'), OuterRef('name'), output_field=CharField()),
+            dataset_type__name__in=spikesort),
+        n_passive=_session_dataset_count(collection__in=['alf', 'raw_passive_data'],
+                                         dataset_type__name__in=passive),
+        n_video=_session_dataset_count(collection__in=['alf', 'raw_video_data'],
+                                       dataset_type__name__in=video),
+    )
 
+
+def get_data_status_qs(probe_insertions):
+    """
+    :param probe_insertions: probe insertions annotated by annotate_data_status
+    """
     data_status = {'behav': [],
                    'spikesort': [],
                    'passive': [],
                    'video': []}
 
-    critical_behav_a = ['trials.table']
-    critical_behav_b = [dset[0] for dset in expected_data.TRIALS if dset[2]]
-    critical_spikesort = [dset[0] for dset in expected_data.SPIKE_SORTING if dset[2]]
-    critical_passive = [dset[0] for dset in (expected_data.PASSIVE + expected_data.RAW_PASSIVE) if dset[2]]
-    critical_video = [dset[0] for dset in (expected_data.VIDEO + expected_data.RAW_VIDEO) if dset[2]]
+    _, critical_behav_b, critical_spikesort, critical_passive, critical_video = _critical_datasets()
 
     for pr in probe_insertions:
-        pr_dsets = pr.session.data_dataset_session_related
-        dsets = pr_dsets.filter(collection__in=['alf'],
-                                dataset_type__name__in=critical_behav_a)
         # if there is no trials table, check that all the other datasets are there
-        if dsets.count() == 1:
+        if pr.n_behav_a == 1:
             data_status['behav'].append(True)
         else:
-            # if there is no trials table, check that if the other datasets are there
-            dsets = pr_dsets.filter(collection__in=['alf'],
-                                    dataset_type__name__in=critical_behav_b)
-            data_status['behav'].append(dsets.count() == len(critical_behav_b))
-
-        dsets = pr_dsets.filter(collection__icontains=f'alf/{pr.name}',
-                                dataset_type__name__in=critical_spikesort)
-        data_status['spikesort'].append(dsets.count() >= len(critical_spikesort))
-
-        dsets = pr_dsets.filter(collection__in=['alf', 'raw_passive_data'],
-                                dataset_type__name__in=critical_passive)
-        data_status['passive'].append(dsets.count() == len(critical_passive))
-
-        dsets = pr_dsets.filter(collection__in=['alf', 'raw_video_data'],
-                                dataset_type__name__in=critical_video)
-        data_status['video'].append(dsets.count() == len(critical_video) * 3)
+            data_status['behav'].append(pr.n_behav_b == len(critical_behav_b))
+        data_status['spikesort'].append(pr.n_spikesort >= len(critical_spikesort))
+        data_status['passive'].append(pr.n_passive == len(critical_passive))
+        data_status['video'].append(pr.n_video == len(critical_video) * 3)
 
     return data_status
 
@@ -0,0 +1,136 @@
+"""
+Denormalised metadata of the report plots displayed in the gallery.
+
+The lab, projects, session and QC of the object each report note is attached to (either a
+probe insertion or a session) are resolved once into a Postgres materialised view, refreshed
+periodically by the `ibl gallery_table` management command:
+
+    python ./manage.py ibl gallery_table
+
+The gallery views join this table to the notes once instead of resolving the columns from the
+probe insertions and sessions on every page load. Notes created since the last refresh are
+listed from the next refresh; if the table has not been created, the first gallery query of the
+process creates it.
+"""
+import logging
+
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection
+from django.db.models import (
+    F, CharField, DateTimeField, IntegerField, TextField, UUIDField)
+from django.db.models.expressions import RawSQL
+
+from misc.models import Note, Lab
+from subjects.models import Project
+from actions.models import Session
+from experiments.models import ProbeInsertion
+
+_logger = logging.getLogger(__name__)
+# whether this process has checked that the gallery table exists
+_table_checked = False
+
+GALLERY_TABLE = 'ibl_reports_gallery'
+REPORT_TAG = '## report ##'
+# columns of the gallery table exposed as attributes of the notes
+GALLERY_COLUMNS = ('lab', 'projects', 'session', 'session_time', 'session_qc', 'behav_qc',
+                   'probe_qc', 'destripe_qc', 'plot_type')
+
+
+def _column_sql():
+    """Map of gallery column name to its SQL expression over the note, probe, session and lab"""
+    session_projects = Session.projects.through._meta.db_table
+    return {
+        'lab': 'lab.name',
+        'projects': f"""ARRAY(SELECT project.name
+                 FROM {session_projects} sp
+                 JOIN {Project._meta.db_table} project ON project.id = sp.project_id
+                 WHERE sp.session_id = session.id
+                 ORDER BY project.name)""",
+        'session': 'session.id',
+        'session_time': 'session.start_time',
+        'session_qc': 'session.qc',
+        'behav_qc': "session.extended_qc ->> 'behavior'",
+        'probe_qc': "probe.json ->> 'qc'",
+        'destripe_qc': "probe.json -> 'extended_qc' ->> 'experimenter_raw_destripe'",
+        'plot_type': "note.json ->> 'name'",
+    }
+
+
+# output fields of the columns annotated on the notes
+GALLERY_FIELDS = {
+    'lab': CharField(), 'projects': ArrayField(CharField()), 'session': UUIDField(),
+    'session_time': DateTimeField(), 'session_qc': IntegerField(), 'behav_qc': TextField(),
+    'probe_qc': TextField(), 'destripe_qc': TextField(), 'plot_type': TextField(),
+}
+
+_FROM_SQL = f"""
+    FROM {Note._meta.db_table} note
+    LEFT JOIN {ProbeInsertion._meta.db_table} probe ON probe.id = note.object_id
+    LEFT JOIN {Session._meta.db_table} session ON session.id = COALESCE(probe.session_id, note.object_id)
+    LEFT JOIN {Lab._meta.db_table} lab ON lab.id = session.lab_id
+"""
+
+
+def _create_sql():
+    columns = ',\n           '.join(f'{sql} AS {name}' for name, sql in _column_sql().items())
+    return f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {GALLERY_TABLE} AS
+    SELECT note.id AS note_id,
+           {columns}
+    {_FROM_SQL}
+    WHERE note.json ->> 'tag' = '{REPORT_TAG}'
+    """
+
+
+def gallery_table_exists():
+    """Whether the gallery materialised view has been created"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [GALLERY_TABLE])
+        return cursor.fetchone()[0] is not None
+
+
+def refresh_gallery_table(concurrently=True):
+    """
+    Creates the gallery materialised view if it does not exist, refreshes it otherwise.
+
+    :param concurrently: if True, the refresh does not lock the table against reads
+    """
+    exists = gallery_table_exists()
+    with connection.cursor() as cursor:
+        if not exists:
+            _logger.info(f'creating {GALLERY_TABLE}')
+            cursor.execute(_create_sql())
+            # a unique index is required to refresh concurrently
+            cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {GALLERY_TABLE}_note_id ON {GALLERY_TABLE} (note_id)')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {GALLERY_TABLE}_session_time ON {GALLERY_TABLE} (session_time DESC)')
+        else:
+            _logger.info(f'refreshing {GALLERY_TABLE}')
+            cursor.execute(f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrently else ''}{GALLERY_TABLE}")
+        cursor.execute(f'ANALYZE {GALLERY_TABLE}')
+
+
+def ensure_gallery_table():
+    """Creates the gallery table if it does not exist, checked once per process"""
+    global _table_checked
+    if not _table_checked:
+        if not gallery_table_exists():
+            _logger.warning(f'{GALLERY_TABLE} does not exist, creating it')
+            refresh_gallery_table()
+        _table_checked = True
+
+
+def gallery_notes():
+    """
+    Report notes annotated with their gallery metadata, most recent sessions first.
+
+    The gallery table is joined once to the notes and the annotations are its columns, so the
+    filters and the ordering apply to the table directly. Notes created since the last refresh
+    of the table are listed from the next refresh.
+    :return: Note queryset annotated with the GALLERY_COLUMNS
+    """
+    ensure_gallery_table()
+    qs = Note.objects.filter(json__tag=REPORT_TAG).extra(
+        tables=[GALLERY_TABLE], where=[f'{GALLERY_TABLE}.note_id = {Note._meta.db_table}.id'])
+    qs = qs.annotate(**{name: RawSQL(f'{GALLERY_TABLE}.{name}', (), output_field=GALLERY_FIELDS[name])
+                        for name in GALLERY_COLUMNS})
+    return qs.order_by(F('session_time').desc(nulls_last=True))
@@ -0,0 +1,213 @@
+"""
+Training status timeline of the subjects in the training pipeline.
+
+The data of the subjects training status chart of the gallery is precomputed per lab and for all
+labs, and stored as JSON in the media storage by the `ibl training_status` management command:
+
+    python ./manage.py ibl training_status
+
+Each artefact holds a fingerprint of the subjects training criteria and training sessions it was
+computed from; only the artefacts whose fingerprint changed are recomputed.
+"""
+import hashlib
+import json
+import logging
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_hex
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+
+from actions.models import Session
+from misc.models import Lab
+from subjects.models import Subject
+
+_logger = logging.getLogger(__name__)
+
+STATUSES = (
+    'habituation', 'in_training', 'trained_1a', 'trained_1b',
+    'ready4ephysrig', 'ready4delay', 'ready4recording', 'untrainable', 'unbiasable', 'not_computed')
+TRAINING_PROCEDURE = 'Behavior training/tasks'
+STORAGE_PREFIX = 'training_status'
+
+
+def status_colour_map():
+    """Return map of status: hexadecimal colour"""
+    gradient = np.linspace(0, 1, len(STATUSES))
+    return {status: to_hex(plt.cm.hsv(i)) for i, status in zip(gradient, STATUSES)}
+
+
+def training_subjects(lab=None, alive_since=None):
+    """
+    Subjects in the training pipeline, i.e. with training criteria and an ongoing water restriction
+    :param lab: name of the lab of the subjects. If None, subjects of all labs are returned.
+    :param alive_since: If provided, only subjects with a death date after this date are returned,
+     otherwise only live subjects are returned. Format: YYYY-MM-DD
+    """
+    filter_args = dict(json__has_key='trained_criteria')
+    if not alive_since:
+        filter_args['death_date__isnull'] = True
+        filter_args['cull__isnull'] = True
+    if lab:
+        filter_args['lab__name'] = lab
+    subjects = (Subject
+                .objects
+                .filter(**filter_args)
+                .extra(where=['''
+                    subjects_subject.id IN
+                    (SELECT subject_id FROM actions_waterrestriction
+                    WHERE end_time IS NULL)
+                    ''']))
+    if alive_since:
+        subjects = subjects.exclude(death_date__lte=alive_since)
+    return subjects
+
+
+def compute_status_data(lab=None, alive_since=None):
+    """
+    Compute the data required for the subjects training status plot.
+
+    A plot of subject (y-axis) vs date (x-axis), which each point a session whose colour
+    corresponds to the training status on that session.
+
+    :param lab: The name of the lab whose subjects are plotted. If None, all active subjects are plotted.
+    :param alive_since: If provided, only subjects with a death date after this date are plotted. Format: YYYY-MM-DD
+    """
+    # We handle only the live mice that are in the training pipeline
+    subjects = training_subjects(lab=lab, alive_since=alive_since)
+    if subjects.count() == 0:
+        return {}
+    subject_data = subjects.values_list('nickname', 'json')
+    names, crit = zip(*[(name, jsn.get('trained_criteria', {})) for name, jsn in subject_data])
+    training_status = pd.DataFrame.from_records(crit, index=names)
+    # Drop eids and parse dates
+    training_status = (training_status[~training_status.isna()].map(lambda x: date.fromisoformat(x[0]), na_action='ignore'))
+    sessions = (Session
+                .objects
+                .select_related('subject')
+                .filter(subject__in=subjects, procedures__name=TRAINING_PROCEDURE)
+                .values_list('subject__nickname', 'pk', 'start_time__date'))
+    sessions = (pd.DataFrame
+                .from_records(sessions, columns=('subject', 'eid', 'date'))
+                .set_index('subject'))
+
+    # Create map of training status -> mice
+    mice_by_status = (training_status
+                      .map(lambda d: time.mktime(d.timetuple()), na_action='ignore')
+                      .idxmax(axis=1, skipna=True)  # status for latest date
+                      .to_frame()  # allows us to call groupby on values without assignment
+                      .groupby(0))
+    # Sort dict by status
+    mice_by_status = sorted(mice_by_status, key=lambda item: STATUSES.index(item[0]))
+    all_subjects = training_status.index.tolist()
+    all_data = {'datasets': [],
+                'subject_map': {i: s for i, s in enumerate(all_subjects)},
+                'mice_by_status': {x: y.index.tolist() for x, y in mice_by_status}}
+    colour_map = status_colour_map()
+    for i, status in enumerate(filter(lambda s: s in training_status.columns, STATUSES)):
+        data = {'label': status, 'backgroundColor': colour_map[status], 'data': []}
+        # Get a map of subject name and date on which status reached
+        for subject, date_reached in training_status[status].items():
+            subject_idx = all_subjects.index(subject)
+            if not isinstance(date_reached, date):
+                continue  # Status not met for this subject; nothing to plot
+            # Subject map of status -> date reached
+            status_dates = training_status.loc[subject]
+            # In some cases, no sessions as they haven't been annotated as behavior/training task
+            try:
+                # Unique dates of all this subject's sessions
+                session_dates = np.unique(sessions.loc[subject, 'date'])  # use np because sometimes returns single value
+            except KeyError:
+                continue
+            # Plot session dates on or after date when status reached, up until the next of the next status
+            session_dates = session_dates[session_dates >= date_reached]
+            next_date = status_dates[status_dates > date_reached].sort_values()
+            if not next_date.empty:
+                session_dates = session_dates[session_dates <= next_date.values[0]]
+            if len(session_dates) == 0:
+                continue
+            if status in ('untrainable', 'unbiasable') and len(session_dates) > 1:
+                # Add data point for first session only
+                data['data'].append({'x': time.mktime(session_dates[0].timetuple()),
+                                     'y': subject_idx})
+                # Add data points to the previous status
+                all_prev = status_dates[status_dates < date_reached].sort_values(ascending=False)
+                prev_status = next(iter(all_prev.keys()), 'in_training')  # previous training status
+                # NB: Order is important here; 'untrainable' is processed last, after others added
+                prev_data = next(d for d in all_data['datasets'] if d['label'] == prev_status)
+                prev_data['data'].extend(
+                    [{'x': time.mktime(d.timetuple()), 'y': subject_idx} for d in session_dates[1:]])
+            else:
+                data['data'].extend([
+                    {'x': time.mktime(d.timetuple()), 'y': subject_idx} for d in session_dates]
+                )
+        all_data['datasets'].append(data)
+    all_data['datasets'] = list(reversed(all_data['datasets']))
+    for dset in all_data['datasets']:
+        dset['data'] = sorted(dset['data'], key=lambda d: d['x'])
+    return all_data
+
+
+def status_fingerprint(lab=None):
+    """
+    Hash of the inputs of the training status plot of a lab: the training criteria of the
+    subjects and the number and last date of their training sessions
+    :param lab: name of the lab, if None all labs
+    """
+    subjects = training_subjects(lab=lab)
+    criteria = list(subjects.order_by('nickname').values_list('nickname', 'json__trained_criteria'))
+    sessions = list(Session
+                    .objects
+                    .filter(subject__in=subjects, procedures__name=TRAINING_PROCEDURE)
+                    .values('subject__nickname')
+                    .annotate(n=Count('pk'), last=Max('start_time'))
+                    .order_by('subject__nickname')
+                    .values_list('subject__nickname', 'n', 'last'))
+    return hashlib.md5(json.dumps([criteria, sessions], default=str).encode()).hexdigest()
+
+
+def _storage_name(lab=None):
+    return f'{STORAGE_PREFIX}/{lab or "all"}.json'
+
+
+def load_status_data(lab=None):
+    """
+    Load the precomputed training status plot data of a lab
+    :param lab: name of the lab, if None all labs
+    :return: the plot data, or None if it has not been computed
+    """
+    name = _storage_name(lab)
+    if not default_storage.exists(name):
+        return None
+    with default_storage.open(name) as fp:
+        return json.load(fp)['data']
+
+
+def update_training_status(force=False):
+    """
+    Recompute and store the training status plot data of each lab and of all labs, for the labs
+    whose subjects training criteria or training sessions changed since the last run
+    :param force: if True, recompute all labs
+    :return: list of the labs recomputed, None standing for all labs
+    """
+    updated = []
+    for lab in [None, *Lab.objects.order_by('name').values_list('name', flat=True)]:
+        name = _storage_name(lab)
+        fingerprint = status_fingerprint(lab)
+        if not force and default_storage.exists(name):
+            with default_storage.open(name) as fp:
+                if json.load(fp).get('fingerprint') == fingerprint:
+                    continue
+        _logger.info(f'computing training status of {lab or "all labs"}')
+        content = json.dumps({'fingerprint': fingerprint, 'data': compute_status_data(lab=lab)})
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        default_storage.save(name, ContentFile(content.encode()))
+        updated.append(lab)
+    return updated
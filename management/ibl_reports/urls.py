@@ -5,6 +5,7 @@ from ibl_reports import views
 urlpatterns = [
     path('', views.landingpage),
     path('overview', views.InsertionTable.as_view(), name='insertion table'),
+    path('overview/rows', views.InsertionTable.as_view(json=True), name='insertion table rows'),
     path('overview/<uuid:pid>', views.InsertionOverview.as_view(), name='insertion overview'),
     path('task_qc_eid/<uuid:eid>', views.plot_task_qc_eid, name='plot_task_qc_eid'),
     path('video_qc_eid/<uuid:eid>', views.plot_video_qc_eid, name='plot_video_qc_eid'),
@@ -21,5 +22,6 @@ urlpatterns = [
     path('gallery/<uuid:eid>/task', views.GalleryTaskView.as_view(), name='task'),
 
     path('paired_recordings', views.PairedRecordingsView.as_view(), name='paired'),
+    path('paired_recordings/graph', views.PairedRecordingsView.as_view(json=True), name='paired_graph'),
 
 ]
@@ -1,35 +1,43 @@
 from collections import OrderedDict
-from datetime import date
+from datetime import date, datetime
+from functools import lru_cache
+import json
 import logging
+import threading
 import time
+import uuid
 
 import django_filters
 from django import forms
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, Http404
 from django.template import loader
+from django.urls import reverse
 from django.views.generic.list import ListView
-from django.db.models import Q, F, OuterRef, Exists, UUIDField, Max, Count, Func, Subquery, TextField
+from django.db.models import (
+    Q, F, OuterRef, Max, Count, Func, Subquery, TextField, IntegerField, BooleanField, Value, ExpressionWrapper)
 from django.db.models.functions import Coalesce, Cast
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.postgres.fields import JSONField, ArrayField
 from django.core.files.storage import default_storage
 from django.utils.functional import lazy
 
+from data.models import Dataset
 from experiments.models import TrajectoryEstimate, ProbeInsertion
-from misc.models import Note, Lab
-from subjects.models import Project, Subject
+from misc.models import Note
+from subjects.models import Subject
 from actions.models import Session
 from jobs.models import Task
 
 import pyarrow.parquet as pq
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import to_hex
 
 from ibl_reports import qc_check
 from ibl_reports import data_check
 from ibl_reports import data_info
+from ibl_reports import gallery
+from ibl_reports import training_status
+from ibl_reports.choices import lab_choices, project_choices, plot_type_choices
 
 LOGIN_URL = '/admin/login/'
 
@@ -42,53 +50,135 @@ def landingpage(request):
     return HttpResponse(template.render(context, request))
 
 
+"""tuple of str: the custom regions of the U19 paired recordings mapping."""
+U19_ACRONYMS = ('VISp', 'VISam', 'MOs', 'PL', 'LP', 'VAL', 'CP', 'GPe', 'SNr', 'SCm', 'MRN', 'ZI',
+                'FN', 'IRN', 'GRN', 'PRNr')
+
+
+@lru_cache(maxsize=1)
+def brain_regions():
+    """Return the process-wide BrainRegions instance, loaded on first use."""
+    from iblatlas.regions import BrainRegions
+    return BrainRegions()
+
+
+@lru_cache(maxsize=None)
+def region_mapping(mapping):
+    """
+    Return the target region ids and mapping for paired recordings, computed once per process.
+
+    :param mapping: The name of an atlas mapping, e.g. 'Cosmos', or a tuple of acronyms whose
+     descendants are mapped to them, taking into account the hierarchical nature of the brain atlas.
+    :return: The sorted unique target region ids (including 0 for custom mappings), and the mapping
+     name or array to pass to BrainRegions.remap. Arrays are read-only.
+    """
+    from iblutil.numerical import ismember
+    regions = brain_regions()
+    if isinstance(mapping, str):  # in this case we compute the paired recordings for a specific mapping
+        mapped_ids = np.unique(regions.id[regions.mappings[mapping]])
+    else:  # in this case we compute the mapping corresponding to a list of custom regions
+        acronyms = list(mapping)
+        mapped_ids = np.unique(np.r_[regions.acronym2id(acronyms), 0])
+        mapping = np.zeros_like(regions.id)
+        for aid in regions.acronym2id(acronyms):
+            descendants = regions.descendants(aid)['id']
+            irs, _ = ismember(np.abs(regions.id), descendants)  # NB: this is where to work on multi hemisphere
+            mapping[irs] = np.where(aid == regions.id)[0][0]
+        mapping.setflags(write=False)
+    mapped_ids.setflags(write=False)
+    return mapped_ids, mapping
+
+
+@lru_cache(maxsize=None)
+def region_nodes(mapping):
+    """
+    Return the name and colour of each target region of a mapping, computed once per process.
+
+    :param mapping: The name of an atlas mapping or a tuple of acronyms, see region_mapping.
+    :return: A tuple of dicts with keys 'name' (acronym) and 'color' (hexadecimal RGB).
+    """
+    from iblutil.numerical import ismember
+    regions = brain_regions()
+    mapped_ids = region_mapping(mapping)[0][1:]
+    _, index = ismember(mapped_ids, regions.id)
+    rgb = regions.rgb[index].astype(np.int64) @ np.array([0x10000, 0x100, 0x1])
+    return tuple({'name': name, 'color': f'#{colour:06x}'}
+                 for name, colour in zip(regions.id2acronym(mapped_ids), rgb))
+
+
+def remap_regions(atlas_ids, mapping):
+    """Remap Allen atlas ids to the target mapping, remapping each unique id only once."""
+    ids, inverse = np.unique(np.asarray(atlas_ids), return_inverse=True)
+    if ids.size == 0:
+        return np.asarray(atlas_ids)
+    return brain_regions().remap(ids, source_map='Allen', target_map=mapping)[inverse]
+
+
+_paired_experiments = {'version': None, 'df': None, 'checked': -np.inf}
+_paired_experiments_lock = threading.Lock()
+
+
+def load_paired_experiments(name='paired_experiments.pqt', revalidate_after=60):
+    """
+    Return the paired experiments table, downloading it from the media storage only when changed.
+
+    The table is cached in-process and keyed on the modification time of the storage object, so
+    that a new version uploaded by the nightly `ibl paired_recordings` command is picked up on the
+    next request.  The returned data frame is shared and must not be modified in place.
+
+    :param name: The name of the table file in the media storage.
+    :param revalidate_after: The minimum number of seconds between two checks of the storage
+     object modification time.
+    """
+    with _paired_experiments_lock:
+        cached = _paired_experiments['df'] is not None
+        if cached and time.monotonic() - _paired_experiments['checked'] < revalidate_after:
+            return _paired_experiments['df']
+        try:
+            version = default_storage.get_modified_time(name)
+        except NotImplementedError:
+            version = None
+        if not cached or version is None or version != _paired_experiments['version']:
+            logger.info(f'Getting paired experiments files from the media storage backend {default_storage}')
+            with default_storage.open(name) as fp:
+                df = pq.read_table(fp).to_pandas()
+            logger.info('Download successful')
+            _paired_experiments.update(version=version, df=df)
+        _paired_experiments['checked'] = time.monotonic()
+        return _paired_experiments['df']
+
+
 class PairedRecordingsView(LoginRequiredMixin, ListView):
     template_name = 'ibl_reports/paired_recordings.html'
     login_url = LOGIN_URL
+    json = False  # if true, respond with the paired recordings graph as JSON
 
     @property
     def df_paired_experiments(self):
-        logger.info(f'Getting paired experiments files from the media storage backend {default_storage}')
-        with default_storage.open('paired_experiments.pqt') as fp:
-            df = pq.read_table(fp).to_pandas()
-        logger.info('Download successful')
-        return df
+        return load_paired_experiments()
 
-    def get_context_data(self, **kwargs):
-        from iblatlas.regions import BrainRegions
+    def get_paired_graph(self, sessions):
+        """
+        Compute the paired recordings matrix of the given sessions as a graph.
+
+        :param sessions: A queryset of sessions.
+        :return: A dict with the keys 'nodes' (a list of region dicts with keys 'name' and 'color'),
+         'links' (a list of the non-zero matrix entries as dicts with keys 'source', 'target' and
+         'value') and 'matrix' (the sparse paired recordings matrix).
+        """
         from iblutil.numerical import ismember
         import scipy.sparse as sp
 
-        regions = BrainRegions()  # todo need to cache this
-        context = super(PairedRecordingsView, self).get_context_data(**kwargs)
-        context['pairedFilter'] = self.f
-        sessions = context['object_list']
         sessions = sessions.annotate(eid=Cast('id', output_field=TextField()))
         eids = sessions.values_list('eid', flat=True)
         paired_experiments = self.df_paired_experiments
-        mapping_choice = self.request.GET.get('mapping', '1')
-        paired_experiments = paired_experiments[paired_experiments['eid'].isin(eids)]
-        if mapping_choice == '0':
-            mapping = ['VISp', 'VISam', 'MOs', 'PL', 'LP', 'VAL', 'CP', 'GPe', 'SNr', 'SCm', 'MRN', 'ZI',
-                       'FN', 'IRN', 'GRN', 'PRNr']
-        else:
-            mapping = 'Cosmos'
-
-        if isinstance(mapping, str):  # in this case we compute the paired recordings for a specific mapping
-            mapped_ids = np.unique(regions.id[regions.mappings[mapping]])
-        else:  # in this case we compute the mapping corresponding to a list of custom regions, taking into
-            # account the hierarchical nature of the brain atlas
-            acronyms = mapping
-            mapped_ids = np.unique(np.r_[regions.acronym2id(acronyms), 0])
-            mapping = np.zeros_like(regions.id)
-            for aid in regions.acronym2id(acronyms):
-                descendants = regions.descendants(aid)['id']
-                irs, _ = ismember(np.abs(regions.id), descendants)  # NB: this is where to work on multi hemisphere
-                mapping[irs] = np.where(aid == regions.id)[0][0]
+        mapping_key = U19_ACRONYMS if self.request.GET.get('mapping', '1') == '0' else 'Cosmos'
+        paired_experiments = paired_experiments[paired_experiments['eid'].isin(eids)].copy()
+        mapped_ids, mapping = region_mapping(mapping_key)
 
         # remaps the regions to the target map
-        paired_experiments['aida'] = regions.remap(paired_experiments['aida'], source_map='Allen', target_map=mapping)
-        paired_experiments['aidb'] = regions.remap(paired_experiments['aidb'], source_map='Allen', target_map=mapping)
+        paired_experiments['aida'] = remap_regions(paired_experiments['aida'], mapping)
+        paired_experiments['aidb'] = remap_regions(paired_experiments['aidb'], mapping)
 
         # aggregate per per of regions
         plinks = paired_experiments.groupby(['aida', 'aidb']).aggregate(
@@ -99,30 +189,34 @@ class PairedRecordingsView(LoginRequiredMixin, ListView):
         values = np.r_[plinks['n_experiments'], plinks['n_experiments']] / 2
         ia = np.r_[plinks['ia'], plinks['ib']]
         ib = np.r_[plinks['ib'], plinks['ia']]
-        # compute the matrix from the indices and values
-        shared_recordings = sp.coo_matrix((values, (ia, ib)), shape=(mapped_ids.size, mapped_ids.size)).todense()
-        shared_recordings = shared_recordings[1:, 1:]
-
-        def rgb_to_hex(r, g, b):
-            return '#{:02x}{:02x}{:02x}'.format(r, g, b)
+        # compute the sparse matrix from the indices and values, summing duplicate entries
+        shared_recordings = sp.coo_matrix((values, (ia, ib)), shape=(mapped_ids.size, mapped_ids.size))
+        shared_recordings = shared_recordings.tocsr()[1:, 1:].tocoo()
+        shared_recordings.eliminate_zeros()
 
-        nodes = []
-        for r in regions.id2acronym(mapped_ids[1:]):
-            nodes.append({'name': r, 'color': rgb_to_hex(*regions.rgb[regions.acronym2index(r)[1][0][0]])})
-
-        links = []
-        for i in range(shared_recordings.shape[0]):
-            for j in range(shared_recordings.shape[1]):
-                links.append({'source': i, 'target': j, 'value': shared_recordings[i, j]})
-
-        context['nodes'] = nodes
-        context['links'] = links
-        context['data'] = shared_recordings
+        # only the non-zero entries are sent, the other matrix entries default to 0
+        links = pd.DataFrame({'source': shared_recordings.row, 'target': shared_recordings.col,
+                              'value': shared_recordings.data}).to_dict('records')
+        return {'nodes': region_nodes(mapping_key), 'links': links, 'matrix': shared_recordings}
 
+    def get_context_data(self, **kwargs):
+        context = super(PairedRecordingsView, self).get_context_data(**kwargs)
+        context['pairedFilter'] = self.f
+        if not self.json:
+            # The graph is rendered in the page; the JSON endpoint serves the same graph on its own
+            graph = self.get_paired_graph(context['object_list'])
+            context['nodes'] = json.dumps(list(graph['nodes']))
+            context['links'] = json.dumps(graph['links'])
+            context['data'] = graph['matrix']
         return context
 
+    def render_to_response(self, context, **response_kwargs):
+        if self.json:
+            graph = self.get_paired_graph(context['object_list'])
+            return JsonResponse({'nodes': graph['nodes'], 'links': graph['links']})
+        return super(PairedRecordingsView, self).render_to_response(context, **response_kwargs)
+
     def get_queryset(self):
-        # Not optimal as we load this twice....
         paired_experiments = self.df_paired_experiments
         eids = paired_experiments.eid.unique()
         qs = Session.objects.filter(id__in=eids)
@@ -139,6 +233,60 @@ class SubqueryArray(Subquery):
         return ArrayField(base_field=output_fields[0])
 
 
+class SubqueryCount(Subquery):
+    template = '(SELECT COUNT(*) FROM (%(subquery)s) _count)'
+    output_field = IntegerField()
+
+
+# trajectory provenances displayed as flags of the probe insertions
+PROVENANCE_FLAGS = {'planned': 10, 'micro': 30, 'histology': 50, 'aligned': 70}
+
+
+def annotate_provenances(probes):
+    """
+    Annotates probe insertions with the array of the provenances of their trajectories, in a single
+    subquery. Histology trajectories are only counted if they have coordinates.
+    The flags are set on the fetched probes by set_provenance_flags.
+    :param probes: ProbeInsertion queryset
+    """
+    trajectories = (TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'))
+                    .exclude(provenance=PROVENANCE_FLAGS['histology'], x__isnull=True)
+                    .values('provenance'))
+    probes = probes.annotate(provenances=SubqueryArray(trajectories))
+    return probes.annotate(resolved=F('json__extended_qc__alignment_resolved'))
+
+
+def set_provenance_flags(probes):
+    """
+    Sets the PROVENANCE_FLAGS boolean attributes of probes annotated by annotate_provenances
+    :param probes: iterable of probe insertions, evaluated once
+    :return: list of probe insertions
+    """
+    probes = list(probes)
+    for probe in probes:
+        for flag, provenance in PROVENANCE_FLAGS.items():
+            setattr(probe, flag, provenance in (probe.provenances or []))
+    return probes
+
+
+def index_notes(notes, object_ids, plots):
+    """
+    Fetches in one query the notes of several objects and indexes them by (object_id, plot name).
+    When several notes exist for the same key, the first one in the queryset order is kept.
+    :param notes: Note queryset
+    :param object_ids: ids of the sessions, probe insertions or subjects
+    :param plots: iterable of (plot name, ...) tuples, as in data_info.OVERVIEW_SESSION_PLOTS
+    :return: dict {(object_id, plot name): note}
+    """
+    notes = notes.filter(object_id__in=list(object_ids), text__in=[plot[0] for plot in plots])
+    if not notes.ordered:
+        notes = notes.order_by('pk')
+    indexed = {}
+    for note in notes:
+        indexed.setdefault((note.object_id, note.text), note)
+    return indexed
+
+
 class PairedFilter(django_filters.FilterSet):
     """
     Class that filters over Notes queryset.
@@ -161,7 +309,7 @@ class PairedFilter(django_filters.FilterSet):
     )
 
     mapping = django_filters.ChoiceFilter(choices=MAPPING, label='Mapping', method='filter_mapping')
-    project = django_filters.ModelChoiceFilter(queryset=Project.objects.all(), label='Project', method='filter_project')
+    project = django_filters.ChoiceFilter(choices=lazy(project_choices, list)(), label='Project', method='filter_project')
     critical_qc = django_filters.ChoiceFilter(choices=CRITICAL_QC, label='QC', method='filter_critical_qc')
     provenance_qc = django_filters.ChoiceFilter(choices=PROVENANCE, label='Provenance', method='filter_provenance')
 
@@ -187,7 +335,7 @@ class PairedFilter(django_filters.FilterSet):
         return qs
 
     def filter_project(self, queryset, name, value):
-        queryset = queryset.filter(projects__name=value.name)
+        queryset = queryset.filter(projects__name=value)
         return queryset
 
     def filter_mapping(self, queryset, name, value):
@@ -291,8 +439,9 @@ class InsertionOverview(LoginRequiredMixin, ListView):
     def get_context_data(self, **kwargs):
         context = super(InsertionOverview, self).get_context_data(**kwargs)
         probe = context['object_list'][0]
-        session = Session.objects.get(id=probe.session.id)
-        dsets = session.data_dataset_session_related
+        session = Session.objects.prefetch_related('tasks').get(id=probe.session.id)
+        # Fetch the session datasets once; the expected dataset checks are evaluated in memory
+        dsets = data_check.DatasetIndex(session.data_dataset_session_related)
 
         context['probe'] = probe
         context['session'] = session
@@ -318,50 +467,111 @@ class InsertionOverview(LoginRequiredMixin, ListView):
         return qs
 
 
+def encode_cursor(start_time, pk):
+    return f'{start_time.isoformat() if start_time else ""}_{pk}'
+
+
+def decode_cursor(cursor):
+    # a malformed cursor raises a ValueError, including its pk
+    start_time, pk = cursor.rsplit('_', 1)
+    return (datetime.fromisoformat(start_time) if start_time else None), uuid.UUID(pk)
+
+
+def keyset_page(queryset, size, after=None, before=None):
+    """
+    Page of probe insertions ordered by descending session start time and pk, selected on the
+    (session start time, pk) of the last row of the previous page, or of the first row of the
+    next page, so that the cost of a page does not depend on its position. The insertions
+    without session start time are listed last.
+    :param queryset: ProbeInsertion queryset
+    :param size: number of probe insertions per page
+    :param after: cursor of the last row of the previous page
+    :param before: cursor of the first row of the next page
+    :return: list of probe insertions, cursor of the previous page, cursor of the next page.
+     The cursors are None for the first and last pages.
+    """
+    try:
+        start_time, pk = decode_cursor(after or before) if (after or before) else (None, None)
+    except ValueError:
+        raise Http404(f'Invalid cursor "{after or before}"')
+    queryset = queryset.annotate(cursor_time=F('session__start_time'))
+    if before:
+        if start_time is None:
+            qs = queryset.filter(Q(cursor_time__isnull=False) | Q(cursor_time__isnull=True, pk__gt=pk))
+        else:
+            qs = queryset.filter(Q(cursor_time__gt=start_time) | Q(cursor_time=start_time, pk__gt=pk))
+        page = list(qs.order_by(F('cursor_time').asc(nulls_first=True), 'pk')[:size + 1])
+        has_previous, has_next = len(page) > size, True
+        page = page[:size][::-1]
+    else:
+        qs = queryset
+        if after and start_time is None:
+            qs = qs.filter(cursor_time__isnull=True, pk__lt=pk)
+        elif after:
+            qs = qs.filter(Q(cursor_time__lt=start_time) | Q(cursor_time=start_time, pk__lt=pk) |
+                           Q(cursor_time__isnull=True))
+        page = list(qs.order_by(F('cursor_time').desc(nulls_last=True), '-pk')[:size + 1])
+        has_previous, has_next = bool(after), len(page) > size
+        page = page[:size]
+    if not page:
+        return page, None, None
+    previous_cursor = encode_cursor(page[0].cursor_time, page[0].pk) if has_previous else None
+    next_cursor = encode_cursor(page[-1].cursor_time, page[-1].pk) if has_next else None
+    return page, previous_cursor, next_cursor
+
+
 # Insertion table page
 class InsertionTable(LoginRequiredMixin, ListView):
 
     login_url = LOGIN_URL
     template_name = 'ibl_reports/table.html'
-    paginate_by = 50
+    page_size = 50
+    json = False
 
     def get_context_data(self, **kwargs):
         context = super(InsertionTable, self).get_context_data(**kwargs)
+        context['object_list'] = set_provenance_flags(context['object_list'])
         context['data_status'] = data_check.get_data_status_qs(context['object_list'])
         context['tableFilter'] = self.f
+        context['previous_cursor'] = self.previous_cursor
+        context['next_cursor'] = self.next_cursor
+        context['rows_url'] = reverse('insertion table rows')
 
         return context
 
+    def render_to_response(self, context, **response_kwargs):
+        if self.json:
+            rows = loader.render_to_string('ibl_reports/table_rows.html', context, self.request)
+            return JsonResponse({'rows': rows, 'next': self.next_cursor})
+        return super(InsertionTable, self).render_to_response(context, **response_kwargs)
+
     def get_queryset(self):
 
-        qs = ProbeInsertion.objects.all().prefetch_related('session__data_dataset_session_related',
-                                                           'session', 'session__projects',
+        qs = ProbeInsertion.objects.all().prefetch_related('session', 'session__projects',
                                                            'session__subject__lab',)
-        # self.f = InsertionFilter(self.request.GET, queryset=qs)
-        # qs = self.f.qs
         qs = qs.annotate(task=F('session__extended_qc__task'),
                          video_left=F('session__extended_qc__videoLeft'),
                          video_right=F('session__extended_qc__videoRight'),
                          video_body=F('session__extended_qc__videoBody'),
                          behavior=F('session__extended_qc__behavior'),
                          insertion_qc=F('json__qc'))
-        qs = qs.annotate(planned=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=10)))
-        qs = qs.annotate(micro=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=30)))
-        qs = qs.annotate(histology=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=50,
-                                              x__isnull=False)))
-        qs = qs.annotate(resolved=F('json__extended_qc__alignment_resolved'))
+        qs = annotate_provenances(qs)
+        qs = data_check.annotate_data_status(qs)
 
         self.f = InsertionFilter(self.request.GET, queryset=qs)
+        page, self.previous_cursor, self.next_cursor = keyset_page(
+            self.f.qs, self.page_size, after=self.request.GET.get('after'), before=self.request.GET.get('before'))
 
-        return self.f.qs.order_by('-session__start_time')
+        return page
 
 
 class InsertionFilter(django_filters.FilterSet):
 
     id = django_filters.CharFilter(label='Experiment ID/ Probe ID', method='filter_id', lookup_expr='startswith')
+    session__lab = django_filters.ChoiceFilter(
+        field_name='session__lab__name', choices=lazy(lab_choices, list)(), label='Lab')
+    session__projects = django_filters.ChoiceFilter(
+        field_name='session__projects__name', choices=lazy(project_choices, list)(), label='Project')
 
     class Meta:
         model = ProbeInsertion
@@ -372,9 +582,6 @@ class InsertionFilter(django_filters.FilterSet):
 
         super(InsertionFilter, self).__init__(*args, **kwargs)
 
-        self.filters['session__lab'].label = "Lab"
-        self.filters['session__projects'].label = "Project"
-
     def filter_id(self, queryset, name, value):
         queryset = queryset.filter(Q(session__id__startswith=value) | Q(id__startswith=value))
         return queryset
@@ -454,21 +661,11 @@ class GalleryOverviewView(LoginRequiredMixin, ListView):
         context['behaviour'] = qc_check.behav_summary(context['session'].extended_qc)
         context['qc'] = qc_check.qc_summary(context['session'].extended_qc)
 
-        probes = ProbeInsertion.objects.filter(session=self.eid).prefetch_related('trajectory_estimate').order_by('name')
-        probes = probes.annotate(planned=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=10)))
-        probes = probes.annotate(micro=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=30)))
-        probes = probes.annotate(histology=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=50,
-                                              x__isnull=False)))
-        probes = probes.annotate(aligned=Exists(
-            TrajectoryEstimate.objects.filter(probe_insertion=OuterRef('pk'), provenance=70)))
-        probes = probes.annotate(resolved=F('json__extended_qc__alignment_resolved'))
+        probes = annotate_provenances(ProbeInsertion.objects.filter(session=self.eid).order_by('name'))
         probes = probes.annotate(qc=F('json__qc'))
         probes = probes.annotate(n_units=F('json__n_units'))
         probes = probes.annotate(n_good_units=F('json__n_units_qc_pass'))
-        context['probes'] = probes
+        context['probes'] = set_provenance_flags(probes)
 
         return context
 
@@ -505,37 +702,16 @@ class GalleryPlotsOverview(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
 
-        qs = Note.objects.all().filter(json__tag="## report ##")
-        qs = qs.annotate(lab=Coalesce(ProbeInsertion.objects.filter(id=OuterRef('object_id')).values('session__lab__name'),
-                                      Session.objects.filter(id=OuterRef('object_id')).values('lab__name')))
-        qs = qs.annotate(project=Coalesce(ProbeInsertion.objects.filter(id=OuterRef('object_id')).values(
-            'session__projects__name'), Session.objects.filter(id=OuterRef('object_id')).values('projects__name')))
-        qs = qs.annotate(session=Coalesce(ProbeInsertion.objects.filter(id=OuterRef('object_id')).values(
-            'session'), Session.objects.filter(id=OuterRef('object_id')).values('pk'), output_field=UUIDField()))
-
-        qs = qs.annotate(session_time=Coalesce(ProbeInsertion.objects.filter(id=OuterRef('object_id')).values(
-            'session__start_time'), Session.objects.filter(id=OuterRef('object_id')).values('start_time')))
-
-        qs = qs.annotate(session_qc=Coalesce(ProbeInsertion.objects.filter(id=OuterRef('object_id')).values(
-            'session__qc'), Session.objects.filter(id=OuterRef('object_id')).values('qc')))
-
-        qs = qs.annotate(behav_qc=Coalesce(ProbeInsertion.objects.filter(id=OuterRef('object_id')).values(
-            'session__extended_qc__behavior'), Session.objects.filter(id=OuterRef('object_id')).values('extended_qc__behavior')))
-
-        qs = qs.annotate(probe_qc=ProbeInsertion.objects.filter(id=OuterRef('object_id')).values('json__qc'))
-
-        qs = qs.annotate(destripe_qc=ProbeInsertion.objects.filter(
-            id=OuterRef('object_id')).values('json__extended_qc__experimenter_raw_destripe'))
-
-        qs = qs.annotate(plot_type=Note.objects.filter(id=OuterRef('id')).values('json__name'))
-        self.f = GalleryFilter(self.request.GET, queryset=qs.order_by('-session_time'))
+        # lab, project, session and QC of the notes are looked up in the gallery table
+        qs = gallery.gallery_notes()
+        self.f = GalleryFilter(self.request.GET, queryset=qs)
         return self.f.qs
 
 
 class GalleryFilter(django_filters.FilterSet):
     """
     Class that filters over Notes queryset.
-    Annotations are provided by the list view
+    The notes are annotated with the gallery table columns by the list view, see gallery.gallery_notes
     """
     REPEATEDSITE = (
         (0, 'All'),
@@ -558,18 +734,10 @@ class GalleryFilter(django_filters.FilterSet):
         (1, 'Fail'),
     )
 
-    @staticmethod
-    def _get_plot_options():
-        plot_options = []
-        plot_types = Note.objects.all().filter(json__tag="## report ##").values_list("text", flat=True).distinct()
-        for ip, pl in enumerate(plot_types):
-            plot_options.append((ip, pl))
-        return plot_options
-
     id = django_filters.CharFilter(label='Experiment ID/ Probe ID', method='filter_id', lookup_expr='startswith')
-    plot = django_filters.ChoiceFilter(choices=lazy(_get_plot_options, list)(), label='Plot Type', method='filter_plot')
-    lab = django_filters.ModelChoiceFilter(queryset=Lab.objects.all(), label='Lab')
-    project = django_filters.ModelChoiceFilter(queryset=Project.objects.all(), label='Project', method='filter_project')
+    plot = django_filters.ChoiceFilter(choices=lazy(plot_type_choices, list)(), label='Plot Type', method='filter_plot')
+    lab = django_filters.ChoiceFilter(choices=lazy(lab_choices, list)(), label='Lab', method='filter_lab')
+    project = django_filters.ChoiceFilter(choices=lazy(project_choices, list)(), label='Project', method='filter_project')
     repeated = django_filters.ChoiceFilter(choices=REPEATEDSITE, label='Location', method='filter_repeated')
     critical_qc = django_filters.ChoiceFilter(choices=CRITICAL_QC, label='QC', method='filter_critical_qc')
     behavior_qc = django_filters.ChoiceFilter(choices=BEHAVIOR_QC, label='Behaviour', method='filter_behav_qc')
@@ -583,20 +751,25 @@ class GalleryFilter(django_filters.FilterSet):
     def __init__(self, *args, **kwargs):
         super(GalleryFilter, self).__init__(*args, **kwargs)
 
+    def filter_lab(self, queryset, name, value):
+        return queryset.filter(lab=value)
+
     def filter_behav_qc(self, queryset, name, value):
         if value == '0':
-            queryset = queryset.filter(behav_qc=1)
+            queryset = queryset.filter(behav_qc='1')
         elif value == '1':
-            queryset = queryset.filter(behav_qc=0)
+            queryset = queryset.filter(behav_qc='0')
 
         return queryset
 
     def filter_critical_qc(self, queryset, name, value):
-
+        # notes without probe or session QC are non-critical
+        critical = Coalesce(ExpressionWrapper(Q(probe_qc='CRITICAL') | Q(session_qc=50), output_field=BooleanField()),
+                            Value(False))
         if value == '0':
-            queryset = queryset.exclude(Q(probe_qc='CRITICAL') | Q(session_qc=50))
+            queryset = queryset.annotate(critical=critical).filter(critical=False)
         elif value == '1':
-            queryset = queryset.filter(Q(probe_qc='CRITICAL') | Q(session_qc=50))
+            queryset = queryset.annotate(critical=critical).filter(critical=True)
 
         return queryset
 
@@ -612,17 +785,15 @@ class GalleryFilter(django_filters.FilterSet):
         return queryset
 
     def filter_project(self, queryset, name, value):
-        queryset = queryset.filter(projects=value.name)
-        return queryset
+        return queryset.filter(projects__contains=[value])
 
     def filter_plot(self, queryset, name, value):
-        text = [pl[1] for pl in _get_plot_options() if pl[0] == int(value)][0]
-        queryset = queryset.filter(text=text)
+        queryset = queryset.filter(text=value)
         return queryset
 
     def filter_id(self, queryset, name, value):
-        queryset = queryset.filter(Q(object_id__startswith=value) | Q(session__startswith=value))
-        return queryset
+        queryset = queryset.annotate(object_text=Cast('object_id', TextField()), session_text=Cast('session', TextField()))
+        return queryset.filter(Q(object_text__startswith=value) | Q(session_text__startswith=value))
 
     def filter_repeated(self, queryset, name, value):
         pids = ProbeInsertion.objects.filter(trajectory_estimate__provenance=10,
@@ -655,11 +826,16 @@ class SessionImportantPlots(LoginRequiredMixin, ListView):
         data = []
         s = []
 
+        probes = {sess.id: sorted(sess.probe_insertion.all(), key=lambda p: p.name) for sess in sessions}
+        object_ids = list(probes.keys()) + [p.id for pp in probes.values() for p in pp]
+        plots = data_info.OVERVIEW_SESSION_PLOTS + data_info.OVERVIEW_PROBE_PLOTS
+        session_notes = index_notes(notes, object_ids, plots)
+
         for sess in sessions:
             qc_info = {}
 
-            qc_info['Tasks'] = len(sess.tasks.all())
-            qc_info['Dsets'] = len(sess.data_dataset_session_related.all())
+            qc_info['Tasks'] = sess.n_tasks
+            qc_info['Dsets'] = sess.n_datasets
             qc_info['session'] = sess.get_qc_display
 
             if sess.extended_qc:
@@ -674,17 +850,15 @@ class SessionImportantPlots(LoginRequiredMixin, ListView):
 
             plot_dict = {}
             for plot in data_info.OVERVIEW_SESSION_PLOTS:
-                note = notes.filter(object_id=sess.id, text=plot[0]).first()
+                note = session_notes.get((sess.id, plot[0]))
                 if note:
                     plot_dict[plot[0]] = note
 
-            probes = sess.probe_insertion.values().order_by('name')
-            if probes.count() > 0:
-                for probe in probes:
-                    for plot in data_info.OVERVIEW_PROBE_PLOTS:
-                        note = notes.filter(object_id=probe['id'], text=plot[0]).first()
-                        if note:
-                            plot_dict[f'{plot[0]}_{probe["name"]}'] = note
+            for probe in probes[sess.id]:
+                for plot in data_info.OVERVIEW_PROBE_PLOTS:
+                    note = session_notes.get((probe.id, plot[0]))
+                    if note:
+                        plot_dict[f'{plot[0]}_{probe.name}'] = note
 
             data.append(plot_dict)
 
@@ -692,6 +866,9 @@ class SessionImportantPlots(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         qs = Session.objects.all().prefetch_related('probe_insertion')
+        qs = qs.annotate(n_tasks=SubqueryCount(Task.objects.filter(session=OuterRef('pk')).values('pk')),
+                         n_datasets=SubqueryCount(
+                             Dataset.objects.filter(session=OuterRef('pk')).values('pk')))
 
         self.f = SessionFilter(self.request.GET, queryset=qs)
 
@@ -706,8 +883,9 @@ class SessionFilter(django_filters.FilterSet):
     )
 
     id = django_filters.CharFilter(label='Experiment ID/ Probe ID', method='filter_id', lookup_expr='startswith')
-    lab = django_filters.ModelChoiceFilter(queryset=Lab.objects.all(), label='Lab')
-    projects = django_filters.ModelChoiceFilter(queryset=Project.objects.all(), label='Project')
+    lab = django_filters.ChoiceFilter(field_name='lab__name', choices=lazy(lab_choices, list)(), label='Lab')
+    projects = django_filters.ChoiceFilter(
+        field_name='projects__name', choices=lazy(project_choices, list)(), label='Project')
     repeated = django_filters.ChoiceFilter(choices=REPEATEDSITE, label='Location', method='filter_repeated')
     protocol = django_filters.CharFilter(label='Protocol', method='filter_protocol')
 
@@ -741,9 +919,7 @@ class SubjectTrainingPlots(LoginRequiredMixin, ListView):
     template_name = 'ibl_reports/gallery_subject_overview.html'
     login_url = LOGIN_URL
     paginate_by = 20
-    statuses = (
-        'habituation', 'in_training', 'trained_1a', 'trained_1b',
-        'ready4ephysrig', 'ready4delay', 'ready4recording', 'untrainable', 'unbiasable', 'not_computed')
+    statuses = training_status.STATUSES
 
     def get_context_data(self, **kwargs):
         # need to figure out which is more efficient
@@ -762,12 +938,14 @@ class SubjectTrainingPlots(LoginRequiredMixin, ListView):
     def get_my_data(self, subjects, notes):
         data = []
         s = []
+        subject_notes = index_notes(notes.order_by('-date_time'), [subj.id for subj in subjects],
+                                    data_info.OVERVIEW_SUBJECT_PLOTS)
         for subj in subjects:
             info = {}
             s.append(subj)
             plot_dict = {}
             for plot in data_info.OVERVIEW_SUBJECT_PLOTS:
-                note = notes.filter(object_id=subj.id, text=plot[0]).order_by('-date_time').first()
+                note = subject_notes.get((subj.id, plot[0]))
                 if not note and not plot[1]:
                     continue
                 else:
@@ -790,113 +968,33 @@ class SubjectTrainingPlots(LoginRequiredMixin, ListView):
         """
         Fetch the data required for the subjects training status plot.
 
-        A plot of subject (y-axis) vs date (x-axis), which each point a session whose colour
-        corresponds to the training status on that session.
+        The data of the live subjects is precomputed per lab by the `ibl training_status` command
+        and computed on the fly otherwise, see training_status.compute_status_data. The subjects
+        alive since today or a later date, the default of the filter form, are the live subjects.
 
-        :param lab: The UUID of the lab whose subjects are plotted. If None, all active subjects are plotted.
+        :param lab: The name of the lab whose subjects are plotted. If None, all active subjects are plotted.
         :param alive_since: If provided, only subjects with a death date after this date are plotted. Format: YYYY-MM-DD
         """
-        # We handle only the live mice that are in the training pipeline
-        filter_args = dict(json__has_key='trained_criteria')
-        if not alive_since:
-            filter_args['death_date__isnull'] = True
-            filter_args['cull__isnull'] = True
-        if lab:
-            filter_args['lab'] = lab
-        subjects = (Subject
-                    .objects
-                    .filter(**filter_args)
-                    .extra(where=['''
-                        subjects_subject.id IN
-                        (SELECT subject_id FROM actions_waterrestriction
-                        WHERE end_time IS NULL)
-                        ''']))
-        if alive_since:
-            subjects = subjects.exclude(death_date__lte=alive_since)
-        if subjects.count() == 0:
-            return {}
-        subject_data = subjects.values_list('nickname', 'json')
-        names, crit = zip(*[(name, jsn.get('trained_criteria', {})) for name, jsn in subject_data])
-        training_status = pd.DataFrame.from_records(crit, index=names)
-        # Drop eids and parse dates
-        training_status = (training_status[~training_status.isna()].map(lambda x: date.fromisoformat(x[0]), na_action='ignore'))
-        sessions = (Session
-                    .objects
-                    .select_related('subject')
-                    .filter(subject__in=subjects, procedures__name='Behavior training/tasks')
-                    .values_list('subject__nickname', 'pk', 'start_time__date'))
-        sessions = (pd.DataFrame
-                    .from_records(sessions, columns=('subject', 'eid', 'date'))
-                    .set_index('subject'))
-
-        # Create map of training status -> mice
-        mice_by_status = (training_status
-                          .map(lambda d: time.mktime(d.timetuple()), na_action='ignore')
-                          .idxmax(axis=1, skipna=True)  # status for latest date
-                          .to_frame()  # allows us to call groupby on values without assignment
-                          .groupby(0))
-        # Sort dict by status
-        mice_by_status = sorted(mice_by_status, key=lambda item: self.statuses.index(item[0]))
-        all_subjects = training_status.index.tolist()
-        all_data = {'datasets': [],
-                    'subject_map': {i: s for i, s in enumerate(all_subjects)},
-                    'mice_by_status': {x: y.index.tolist() for x, y in mice_by_status}}
-        colour_map = self.status_colour_map()
-        for i, status in enumerate(filter(lambda s: s in training_status.columns, self.statuses)):
-            data = {'label': status, 'backgroundColor': colour_map[status], 'data': []}
-            # Get a map of subject name and date on which status reached
-            for subject, date_reached in training_status[status].items():
-                subject_idx = all_subjects.index(subject)
-                if not isinstance(date_reached, date):
-                    continue  # Status not met for this subject; nothing to plot
-                # Subject map of status -> date reached
-                status_dates = training_status.loc[subject]
-                # In some cases, no sessions as they haven't been annotated as behavior/training task
-                try:
-                    # Unique dates of all this subject's sessions
-                    session_dates = np.unique(sessions.loc[subject, 'date'])  # use np because sometimes returns single value
-                except KeyError:
-                    continue
-                # Plot session dates on or after date when status reached, up until the next of the next status
-                session_dates = session_dates[session_dates >= date_reached]
-                next_date = status_dates[status_dates > date_reached].sort_values()
-                if not next_date.empty:
-                    session_dates = session_dates[session_dates <= next_date.values[0]]
-                if len(session_dates) == 0:
-                    continue
-                if status in ('untrainable', 'unbiasable') and len(session_dates) > 1:
-                    # Add data point for first session only
-                    data['data'].append({'x': time.mktime(session_dates[0].timetuple()),
-                                         'y': subject_idx})
-                    # Add data points to the previous status
-                    all_prev = status_dates[status_dates < date_reached].sort_values(ascending=False)
-                    prev_status = next(iter(all_prev.keys()), 'in_training')  # previous training status
-                    # NB: Order is important here; 'untrainable' is processed last, after others added
-                    prev_data = next(d for d in all_data['datasets'] if d['label'] == prev_status)
-                    prev_data['data'].extend(
-                        [{'x': time.mktime(d.timetuple()), 'y': subject_idx} for d in session_dates[1:]])
-                else:
-                    data['data'].extend([
-                        {'x': time.mktime(d.timetuple()), 'y': subject_idx} for d in session_dates]
-                    )
-            all_data['datasets'].append(data)
-        all_data['datasets'] = list(reversed(all_data['datasets']))
-        for dset in all_data['datasets']:
-            dset['data'] = sorted(dset['data'], key=lambda d: d['x'])
-        return all_data
+        try:
+            live_only = not alive_since or date.fromisoformat(alive_since) >= date.today()
+        except ValueError:
+            live_only = False
+        if live_only:
+            status_data = training_status.load_status_data(lab)
+            if status_data is not None:
+                return status_data
+        return training_status.compute_status_data(lab=lab, alive_since=alive_since)
 
     @staticmethod
     def status_colour_map():
         """Return map of status: hexadecimal colour"""
-        statuses = SubjectTrainingPlots.statuses
-        gradient = np.linspace(0, 1, len(statuses))
-        return {status: to_hex(plt.cm.hsv(i)) for i, status in zip(gradient, statuses)}
+        return training_status.status_colour_map()
 
 
 class SubjectFilter(django_filters.FilterSet):
 
     nickname = django_filters.ModelChoiceFilter(queryset=Subject.objects.all(), label='Nickname')
-    lab = django_filters.ModelChoiceFilter(queryset=Lab.objects.all(), label='Lab')
+    lab = django_filters.ChoiceFilter(field_name='lab__name', choices=lazy(lab_choices, list)(), label='Lab')
     alive_since = django_filters.DateFilter(
         label='Alive Since',
         method='filter_alive_since',
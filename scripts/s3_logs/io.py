@@ -5,13 +5,19 @@ import re
 from io import BytesIO, StringIO
 from typing import Optional
 from itertools import filterfalse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory, gettempdir
-from ipaddress import ip_address
+from ipaddress import ip_address, IPv6Address
 import pickle
 
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from one.remote import aws
 from one.webclient import AlyxClient
 from one.util import validate_date_range
@@ -24,9 +30,39 @@ COL_NAMES = [
     'TLS_version', 'Access_Point_ARN', 'ACL_Required'
 ]
 N_FIELDS = len(COL_NAMES)
+"""tuple of str: log table columns of repeated strings, stored as categoricals."""
+CATEGORICAL_COLUMNS = (
+    'Bucket_Owner', 'Bucket', 'Time_Offset', 'Requester_ARN/Canonical_ID', 'Operation',
+    'Error_Code', 'User_Agent', 'Signature_Version', 'Cipher_Suite', 'Authentication_Type',
+    'Host_Header', 'TLS_version', 'Access_Point_ARN'
+)
+"""dict: the parquet writer options for log tables; zstd compressed with row group statistics."""
+PARQUET_OPTIONS = {'compression': 'zstd', 'row_group_size': 500_000}
 """str: default remote log location, can be found in server access logging config page."""
 REMOTE_LOG_LOCATION = 'info/ibl-brain-wide-map-public/logs/server-access-logs/'
 LOCAL_LOG_LOCATION = Path.home().joinpath('s3_logs')
+"""str: regular expression for parsing the ALF parts of a dataset key (RE2 syntax)."""
+SESSION_KEY_PATTERN = (
+    r'(?P<lab>[\w-]+)/Subjects/(?P<subject>[\w.-]+)/(?P<date>\d{4}-\d{2}-\d{2})/(?P<number>\d{1,3})'
+    r'(?:/(?P<collection>[^/].*?))?/(?P<filename>[^/]+)$'
+)
+"""str: regular expression for parsing the timestamp of a log file key (RE2 syntax)."""
+LOG_TIMESTAMP_PATTERN = r'(?:^|/)\w*?(?P<timestamp>\d{4}(?:-\d{2}){5})[^/]*$'
+"""pathlib.Path: default location of the local IP address info table spanning all months."""
+LOCAL_IP_INFO_STORE = LOCAL_LOG_LOCATION.joinpath('IP-info.pqt')
+"""pathlib.Path: default location of the local year/month partitioned consolidated log store."""
+LOCAL_LOG_STORE = LOCAL_LOG_LOCATION.joinpath('store')
+"""pyarrow.dataset.Partitioning: the directory partitioning of the local log store."""
+LOG_STORE_PARTITIONING = ds.partitioning(
+    pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor='hive')
+"""pyarrow.Schema: the log table columns used for analytics, read from the local log store.
+
+NB: Remote_IP is not included as its type depends on the table version, see `read_log_table`.
+"""
+LOG_STORE_SCHEMA = pa.schema([
+    ('Operation', pa.string()), ('Key', pa.string()),
+    ('Bytes_Sent', pa.int64()), ('year', pa.int16()), ('month', pa.int8())
+])
 
 
 def get_log_directory(key=REMOTE_LOG_LOCATION, s3=None, bucket_name=None):
@@ -146,6 +182,78 @@ def _timestamp(key: str) -> Optional[pd.Timestamp]:
     return pd.Timestamp(*map(int, timestamp.split('-')))
 
 
+def log_timestamps(keys) -> pd.Series:
+    """
+    Parse out datetimes from log filenames with pattern TargetPrefixYYYY-mm-DD-HH-MM-SS-UniqueString.
+
+    This is a vectorised version of `_timestamp` for parsing many keys at once.
+
+    Parameters
+    ----------
+    keys : iterable of str, pd.Series, pyarrow.Array
+        The filepaths of S3 server access log files.
+
+    Returns
+    -------
+    pd.Series
+        The datetimes of the log files.  NaT for irregular key names.
+    """
+    index = keys.index if isinstance(keys, pd.Series) else None
+    parts = pc.extract_regex(_as_string_array(keys), LOG_TIMESTAMP_PATTERN)
+    timestamps = pc.strptime(parts.field('timestamp'), format='%Y-%m-%d-%H-%M-%S', unit='s',
+                             error_is_null=True)
+    return pd.Series(timestamps.to_pandas(), index=index, name='timestamp')
+
+
+def parse_session_keys(keys) -> pd.DataFrame:
+    """
+    Parse the session parts of many dataset keys at once.
+
+    The regular expression is evaluated over the whole string array by pyarrow, avoiding
+    calling the ALF path parser once per key.
+
+    Parameters
+    ----------
+    keys : iterable of str, pd.Series, pyarrow.Array
+        Object keys, e.g. 'data/lab/Subjects/subject/2020-01-01/001/alf/obj.attr.uuid.npy'.
+
+    Returns
+    -------
+    pd.DataFrame
+        A data frame with the columns ('lab', 'subject', 'date', 'number', 'collection',
+        'filename', 'session_path'), one row per key.  The values are null for keys that are not
+        session datasets.  The session path has the form 'lab/Subjects/subject/date/number'.
+
+    Examples
+    --------
+    Count the number of unique sessions accessed
+
+    >>> n_sessions = parse_session_keys(df['Key'].unique())['session_path'].nunique()
+    """
+    index = keys.index if isinstance(keys, pd.Series) else None
+    parts = pc.extract_regex(_as_string_array(keys), SESSION_KEY_PATTERN)
+    if isinstance(parts, pa.ChunkedArray):
+        parts = parts.combine_chunks()
+    names = [parts.type.field(i).name for i in range(parts.type.num_fields)]
+    fields = parts.flatten()
+    session_path = pc.binary_join_element_wise(
+        fields[0], 'Subjects', *fields[1:4], '/', null_handling='emit_null')
+    table = pa.Table.from_arrays([*fields, session_path], names=names + ['session_path'])
+    df = table.to_pandas()
+    if index is not None:
+        df.index = index
+    return df
+
+
+def _as_string_array(keys):
+    """Return an iterable of strings as a pyarrow string array."""
+    if isinstance(keys, (pa.Array, pa.ChunkedArray)):
+        return keys.cast(pa.string())
+    if isinstance(keys, (pd.Series, pd.Index)):
+        return pa.array(keys.astype(object), type=pa.string(), from_pandas=True)
+    return pa.array(list(keys) if not isinstance(keys, np.ndarray) else keys, type=pa.string())
+
+
 def _within_range(timestamp, date_range) -> bool:
     """
     Check if a given datetime is within the provided range.
@@ -168,11 +276,93 @@ def _within_range(timestamp, date_range) -> bool:
     return start < timestamp < end
 
 
-def _iter_objects(log_location, date_range=None, s3_bucket=None):
+def _in_date_range(objects, date_range=None):
+    """
+    Filter S3 objects by the timestamp of their log file keys.
+
+    Parameters
+    ----------
+    objects : list of s3.ObjectSummary, s3.Object
+        A list of S3 log file objects.
+    date_range : (pd.Timestamp, pd.Timestamp), Optional
+        The start and end timestamps.
+
+    Returns
+    -------
+    list
+        The objects whose key datetime is valid and within the provided date range.
+    """
+    if not objects:
+        return []
+    timestamps = log_timestamps([obj.key for obj in objects])
+    valid = timestamps.notna()
+    if date_range:
+        valid &= (timestamps > date_range[0]) & (timestamps < date_range[1])
+    return [obj for obj, v in zip(objects, valid) if v]
+
+
+def _shard_prefixes(date_range, shard='day'):
+    """
+    Return the log key prefixes of each day or hour within a date range.
+
+    Parameters
+    ----------
+    date_range : (pd.Timestamp, pd.Timestamp)
+        The start and end timestamps.
+    shard : {'day', 'hour'}
+        The period of each prefix.
+
+    Returns
+    -------
+    list of str
+        The key prefixes, e.g. ['2023-03-01', '2023-03-02', ...] for shard='day'.
+    """
+    start, end = date_range
+    if shard == 'day':
+        fmt, freq = '%Y-%m-%d', pd.Timedelta(days=1)
+        start = start.normalize()
+    elif shard == 'hour':
+        fmt, freq = '%Y-%m-%d-%H', pd.Timedelta(hours=1)
+        start = start.replace(minute=0, second=0, microsecond=0, nanosecond=0)
+    else:
+        raise ValueError(f'Unknown shard period "{shard}"; expected "day" or "hour"')
+    return [x.strftime(fmt) for x in pd.date_range(start, end, freq=freq)]
+
+
+def _list_keys(client, bucket_name, prefix):
+    """
+    List the keys of all non-folder objects with a given prefix.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A (thread-safe) S3 client.
+    bucket_name : str
+        The name of the S3 bucket.
+    prefix : str
+        The key prefix to list.
+
+    Returns
+    -------
+    list of str
+        The object keys.
+    """
+    paginator = client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.extend(x['Key'] for x in page.get('Contents', [])
+                    if not (x['Key'].endswith('/') and x['Size'] == 0))
+    return keys
+
+
+def _iter_objects(log_location, date_range=None, s3_bucket=None, n_workers=8, shard='day'):
     """
     Iterate over S3 objects in a collection, yield log file keys that fall within a given date
     range.
 
+    When a date range is provided, the listing is split into one key prefix per day (or hour),
+    which are listed concurrently and yielded in chronological order.
+
     Parameters
     ----------
     log_location : str
@@ -181,13 +371,30 @@ def _iter_objects(log_location, date_range=None, s3_bucket=None):
         An optional date range to filter logs by.
     s3_bucket: s3.bucket
         An s3 bucket instance
+    n_workers : int
+        The maximum number of prefixes listed concurrently.  If 1, the common prefix of the date
+        range is listed sequentially.
+    shard : {'day', 'hour'}
+        The period of each listed prefix.
 
     Yields
     -------
-    s3.ObjectSummary
+    s3.ObjectSummary, s3.Object
         An S3 object within the log_dir, whose key datetime is within the provided date range.
     """
     date_range = validate_date_range(date_range)
+    if date_range and n_workers > 1:
+        if not s3_bucket:
+            s3, bucket_name = aws.get_s3_from_alyx(AlyxClient())
+            s3_bucket = s3.Bucket(name=bucket_name)
+        # Clients are thread-safe, unlike resources, so list with the bucket's client
+        list_keys = partial(_list_keys, s3_bucket.meta.client, s3_bucket.name)
+        prefixes = [log_location + x for x in _shard_prefixes(date_range, shard)]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for keys in executor.map(list_keys, prefixes):
+                yield from _in_date_range(list(map(s3_bucket.Object, keys)), date_range)
+        return
+
     if date_range:
         # Filter on common key server-side (significantly improves performance)
         # e.g. for ['2022-01-01', '2022-08-15'], filter keys starting '2022-0'
@@ -201,9 +408,9 @@ def _iter_objects(log_location, date_range=None, s3_bucket=None):
     else:
         file_objects = get_log_directory(log_location)
 
-    for obj in filterfalse(aws.is_folder, file_objects):
-        if (ts := _timestamp(obj.key)) and _within_range(ts, date_range):
-            yield obj
+    # Parse the timestamps of each page of keys at once
+    for page in file_objects.pages():
+        yield from _in_date_range(list(filterfalse(aws.is_folder, page)), date_range)
 
 
 def _iter_logs(log_location, date_range=None, s3_bucket=None):
@@ -490,10 +697,63 @@ def get_remote_log_date_range(log_location=REMOTE_LOG_LOCATION, s3_bucket=None):
     return _timestamp(log_files[0]), _timestamp(log_files[-1])
 
 
+def ips_to_bytes(ips):
+    """
+    Pack IP address strings as 16 byte binary strings.
+
+    IPv4 addresses are stored as IPv4-mapped IPv6 addresses.  Each unique address is only parsed
+    once.
+
+    Parameters
+    ----------
+    ips : pd.Series
+        A series of IP address strings.  Invalid addresses, such as '-', become null.
+
+    Returns
+    -------
+    pd.Series
+        A series of packed IP addresses.
+    """
+    def pack(ip):
+        try:
+            ip = ip_address(ip)
+        except ValueError:
+            return None
+        return (IPv6Address(f'::ffff:{ip}') if ip.version == 4 else ip).packed
+    return ips.map({ip: pack(ip) for ip in pd.unique(ips)})
+
+
+def bytes_to_ips(ips):
+    """
+    Convert packed 16 byte IP addresses to IP address strings.
+
+    Parameters
+    ----------
+    ips : pd.Series
+        A series of packed IP addresses, as returned by `ips_to_bytes`.
+
+    Returns
+    -------
+    pd.Series
+        A series of IP address strings.  Null values become '-'.
+    """
+    def unpack(ip):
+        if not isinstance(ip, bytes):
+            return '-'
+        ip = IPv6Address(ip)
+        return str(ip.ipv4_mapped or ip)
+    return ips.map({ip: unpack(ip) for ip in pd.unique(ips)})
+
+
 def prepare_for_parquet(df):
     """
     Ensures log table has correct column names and data types suitable for parquet.
 
+    Repeated strings are stored as categoricals, sizes and times as (nullable) integers, the
+    request time as a UTC datetime and the remote IP address as a 16 byte binary string.  The
+    rows are sorted by request time.  This function may be called on an already prepared table,
+    e.g. after concatenating two prepared tables.
+
     Parameters
     ----------
     df : pandas.DataFrame
@@ -513,19 +773,53 @@ def prepare_for_parquet(df):
         df['ACL_Required'] = pd.NA
 
     # Ensure correct data types for pyarrow
-    df.loc[df['Bytes_Sent'] == '-', 'Bytes_Sent'] = 0
-    df['Bytes_Sent'] = df['Bytes_Sent'].astype(np.int64)
+    df['Bytes_Sent'] = df['Bytes_Sent'].replace('-', 0).astype(np.int64)
     for col in ('Object_Size', 'Turn_Around_Time', 'Total_Time'):
-        df.loc[df[col] == '-', col] = np.nan
-        df[col] = df[col].astype(float)
+        df[col] = pd.to_numeric(df[col].replace('-', np.nan), errors='coerce').astype('Int64')
 
     # In some instances there is no http status code for example for the operation REST.COPY.OBJECT_GET
     # For these we set the http_status to -1
-    df.loc[df.HTTP_status == '-', 'HTTP_status'] = -1
-
     # In some instance the http status is given as a string, convert to int
-    df['HTTP_status'] = df['HTTP_status'].astype(int)
+    df['HTTP_status'] = df['HTTP_status'].replace('-', -1).astype(np.int16)
+    df['ACL_Required'] = df['ACL_Required'].astype(object)
     df.loc[df.ACL_Required.isin(('-', np.nan)), 'ACL_Required'] = pd.NA
+
+    # Compact types for faster scans and smaller files
+    if not pd.api.types.is_datetime64_any_dtype(df['Time']):
+        df['Time'] = pd.to_datetime(df['Time'] + df['Time_Offset'], format='[%d/%b/%Y:%H:%M:%S%z]', utc=True)
+    if pd.api.types.infer_dtype(df['Remote_IP'], skipna=True) != 'bytes':
+        df['Remote_IP'] = ips_to_bytes(df['Remote_IP'])
+    for col in CATEGORICAL_COLUMNS:
+        df[col] = df[col].astype(object).astype('category')
+    return df.sort_values('Time', kind='stable', ignore_index=True)
+
+
+def read_log_table(source, columns=None, filters=None):
+    """
+    Load a consolidated log table, converting the remote IP addresses to strings.
+
+    Both the typed tables written by `prepare_for_parquet` and older tables where the remote IP
+    address is stored as a string are supported.
+
+    Parameters
+    ----------
+    source : str, pathlib.Path, file-like object
+        The parquet file to load.
+    columns : list of str, optional
+        The columns to load.
+    filters : pyarrow.compute.Expression, optional
+        A row filter to push down to the parquet reader.
+
+    Returns
+    -------
+    pd.DataFrame
+        A data frame of AWS S3 access logs.
+    """
+    table = pq.read_table(source, columns=columns, filters=filters)
+    df = table.to_pandas()
+    # The type of the remote IP column tells typed tables from older ones
+    if 'Remote_IP' in table.column_names and pa.types.is_binary(table.schema.field('Remote_IP').type):
+        df['Remote_IP'] = bytes_to_ips(df['Remote_IP'])
     return df
 
 
@@ -564,7 +858,7 @@ def download_public_logs(download_location=None, date_range=None, s3_bucket=None
         local_path = download_location.joinpath(f'{range_str}_{bucket_name}.pqt')
         local_path.parent.mkdir(parents=True, exist_ok=True)
         print(f'Saving to {local_path}')
-        prepare_for_parquet(df).to_parquet(local_path)
+        prepare_for_parquet(df).to_parquet(local_path, **PARQUET_OPTIONS)
         return df
 
 
@@ -596,7 +890,7 @@ def load_all_local_logs(local_log_location=None, glob_pattern='*.pqt'):
     return all_logs
 
 
-def upload_table(df, key, bucket):
+def upload_table(df, key, bucket, **kwargs):
     """
     Upload a data frame to a given bucket location.
 
@@ -610,6 +904,8 @@ def upload_table(df, key, bucket):
         The destination location within the bucket.
     bucket : s3.Bucket
         The S3 bucket object.
+    **kwargs
+        Parquet writer options passed to `pd.DataFrame.to_parquet`, e.g. PARQUET_OPTIONS.
     """
     if isinstance(key, str):
         key = PurePosixPath(key)
@@ -617,7 +913,7 @@ def upload_table(df, key, bucket):
     with TemporaryDirectory() as tdir:
         # Save
         filepath = Path(tdir) / key.name
-        df.to_parquet(filepath)
+        df.to_parquet(filepath, **kwargs)
         # Upload
         bucket.upload_file(str(filepath), key.as_posix())
 
@@ -628,3 +924,274 @@ def upload_table(df, key, bucket):
         bucket.download_file(key.as_posix(), str(filepath))
         df2 = pd.read_parquet(filepath)
         assert (df2.size == df.size) and (df2.shape == df.shape)
+
+
+def load_ip_info_store(store_path=None):
+    """
+    Load the local IP address info table.
+
+    The table holds the details of every IP address looked up so far, across all months, so that
+    only previously unseen addresses need to be queried.
+
+    Parameters
+    ----------
+    store_path : str, pathlib.Path
+        The location of the local IP info parquet table.
+
+    Returns
+    -------
+    pd.DataFrame
+        A data frame of IP address details indexed by IP address. Empty if the store does not
+        exist yet.
+    """
+    store_path = Path(store_path or LOCAL_IP_INFO_STORE)
+    if not store_path.exists():
+        return pd.DataFrame(index=pd.Index([], name='ip', dtype=object))
+    return pd.read_parquet(store_path)
+
+
+def save_ip_info_store(ip_details, store_path=None):
+    """
+    Save the local IP address info table.
+
+    The table is first written to a temporary file which then replaces the store, so that an
+    interrupted write does not corrupt the existing table.
+
+    Parameters
+    ----------
+    ip_details : pd.DataFrame
+        A data frame of IP address details indexed by IP address.
+    store_path : str, pathlib.Path
+        The location of the local IP info parquet table.
+    """
+    store_path = Path(store_path or LOCAL_IP_INFO_STORE)
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    ip_details = ip_details[~ip_details.index.duplicated(keep='last')]
+    ip_details.index.name = 'ip'
+    tmp_path = store_path.with_suffix('.tmp' + store_path.suffix)
+    ip_details.to_parquet(tmp_path)
+    tmp_path.replace(store_path)
+
+
+def sync_ip_info_store(store_path=None, location=None, s3=None, bucket_name=None):
+    """
+    Merge the monthly remote IP info tables into the local IP address info table.
+
+    Parameters
+    ----------
+    store_path : str, pathlib.Path
+        The location of the local IP info parquet table.
+    location : str
+        The location of the consolidated log tables on the private bucket.
+    s3: s3.ServiceResource
+        An S3 resource object
+    bucket_name: str
+        Name of s3 bucket
+
+    Returns
+    -------
+    pd.DataFrame
+        The updated IP address info table.
+    """
+    store = load_ip_info_store(store_path)
+    ip_tables = [store]
+    for obj in iter_log_tables(location=location, s3=s3, bucket_name=bucket_name):
+        if obj.key.endswith('_IP-info.pqt'):
+            ip_tables.append(pd.read_parquet(BytesIO(obj.get()['Body'].read())))
+    # Monthly tables are listed in chronological order so the most recent details are kept,
+    # however entries already in the local store take precedence
+    store = pd.concat(ip_tables[1:] + ip_tables[:1])
+    store = store[~store.index.duplicated(keep='last')]
+    # Drop the addresses without details, e.g. those absent from an offline database
+    if len(details := store.columns.difference(['accessed'])):
+        store = store.dropna(how='all', subset=details)
+    save_ip_info_store(store, store_path)
+    return store
+
+
+def _log_table_month(key):
+    """
+    Parse the year and month from a consolidated log table key.
+
+    Parameters
+    ----------
+    key : str
+        The filepath of a consolidated log table, e.g. 'consolidated/2023-03_ibl-brain-wide-map-public.pqt'.
+
+    Returns
+    -------
+    (int, int)
+        The year and month of the table, or None if the key name is irregular.
+    """
+    if not (match := re.match(r'^(\d{4})-(\d{2})_', PurePosixPath(key).name)):
+        return
+    return tuple(map(int, match.groups()))
+
+
+def sync_log_store(store_location=None, location=None, s3=None, bucket_name=None):
+    """
+    Download the consolidated log tables missing from the local log store.
+
+    Log tables are saved in a year/month partitioned directory structure, e.g.
+    logs/year=2023/month=3/2023-03_ibl-brain-wide-map-public.pqt, and IP info tables are saved in
+    the ip_info folder.  Tables already present locally with the same size as the remote object
+    are skipped.  Local incomplete month tables that no longer exist remotely (i.e. because the
+    month has since been consolidated) are removed.
+
+    Parameters
+    ----------
+    store_location : str, pathlib.Path
+        The location of the local log store.
+    location : str
+        The location of the consolidated log tables on the private bucket.
+    s3: s3.ServiceResource
+        An S3 resource object
+    bucket_name: str
+        Name of s3 bucket
+
+    Returns
+    -------
+    list of pathlib.Path
+        The local paths of the newly downloaded tables.
+    """
+    store_location = Path(store_location or LOCAL_LOG_STORE)
+    remote_files, downloaded = set(), []
+    for obj in iter_log_tables(location=location, s3=s3, bucket_name=bucket_name):
+        name = PurePosixPath(obj.key).name
+        if not (date := _log_table_month(name)):
+            continue
+        if name.endswith('_IP-info.pqt'):
+            local_path = store_location.joinpath('ip_info', name)
+        else:
+            local_path = store_location.joinpath('logs', 'year=%i' % date[0], 'month=%i' % date[1], name)
+        remote_files.add(local_path)
+        if local_path.exists() and local_path.stat().st_size == obj.size:
+            continue
+        print(f'Downloading {obj.key}')
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        # Files starting with '.' are ignored by the dataset reader until the download completes
+        tmp_path = local_path.with_name(f'.{name}.part')
+        obj.meta.client.download_file(obj.bucket_name, obj.key, str(tmp_path))
+        tmp_path.replace(local_path)
+        downloaded.append(local_path)
+    for local_path in store_location.rglob('*_INCOMPLETE.pqt'):
+        if local_path not in remote_files:
+            print(f'Removing superseded table {local_path.name}')
+            local_path.unlink()
+    return downloaded
+
+
+def log_store_dataset(store_location=None):
+    """
+    Return the consolidated logs in the local log store as a dataset for column scans.
+
+    Only the columns in LOG_STORE_SCHEMA are exposed.  Filtering on the 'year' and 'month'
+    partition columns skips the tables of other months entirely, and filters on other columns are
+    pushed down to the parquet row group statistics.
+
+    Parameters
+    ----------
+    store_location : str, pathlib.Path
+        The location of the local log store.
+
+    Returns
+    -------
+    pyarrow.dataset.Dataset
+        The log store dataset.
+
+    Examples
+    --------
+    Load the keys of all files downloaded in March 2023
+
+    >>> dataset = log_store_dataset()
+    >>> expr = (ds.field('year') == 2023) & (ds.field('month') == 3)
+    >>> expr &= ds.field('Operation') == 'REST.GET.OBJECT'
+    >>> keys = dataset.to_table(columns=['Key'], filter=expr).column('Key')
+    """
+    store_location = Path(store_location or LOCAL_LOG_STORE)
+    return ds.dataset(store_location.joinpath('logs'), format='parquet',
+                      schema=LOG_STORE_SCHEMA, partitioning=LOG_STORE_PARTITIONING)
+
+
+def iter_log_store_months(store_location=None, year=None):
+    """
+    Yield the year and month of each partition in the local log store, in chronological order.
+
+    Parameters
+    ----------
+    store_location : str, pathlib.Path
+        The location of the local log store.
+    year : int, str, optional
+        Only yield the months of this year.
+
+    Yields
+    -------
+    (int, int)
+        The year and month of a log store partition.
+    """
+    store_location = Path(store_location or LOCAL_LOG_STORE)
+    months = set()
+    for folder in store_location.joinpath('logs').glob('year=*/month=*'):
+        months.add((int(folder.parent.name[5:]), int(folder.name[6:])))
+    for date in sorted(months):
+        if year is None or date[0] == int(year):
+            yield date
+
+
+def load_ip_info_month(year, month, store_location=None):
+    """
+    Load the IP info table of a given month from the local log store.
+
+    Parameters
+    ----------
+    year : int
+        The year of the IP info table.
+    month : int
+        The month of the IP info table.
+    store_location : str, pathlib.Path
+        The location of the local log store.
+
+    Returns
+    -------
+    pd.DataFrame
+        The IP address details indexed by IP address, or None if there is no table for this month.
+    """
+    store_location = Path(store_location or LOCAL_LOG_STORE)
+    pattern = f'{year:04d}-{month:02d}_*_IP-info.pqt'
+    if not (files := sorted(store_location.joinpath('ip_info').glob(pattern))):
+        return
+    ip_details = pd.concat(map(pd.read_parquet, files))
+    return ip_details[~ip_details.index.duplicated(keep='last')]
+
+
+def read_log_store_month(year, month, columns=None, filters=None, store_location=None):
+    """
+    Load the consolidated logs of a given month from the local log store.
+
+    Each table of the month is read separately with `read_log_table` so that tables of any
+    version may be loaded, including the Remote_IP column.
+
+    Parameters
+    ----------
+    year : int
+        The year of the logs.
+    month : int
+        The month of the logs.
+    columns : list of str, optional
+        The columns to load.
+    filters : pyarrow.compute.Expression, optional
+        A row filter to push down to the parquet reader.
+    store_location : str, pathlib.Path
+        The location of the local log store.
+
+    Returns
+    -------
+    pd.DataFrame
+        A data frame of AWS S3 access logs.
+    """
+    store_location = Path(store_location or LOCAL_LOG_STORE)
+    partition = store_location.joinpath('logs', 'year=%i' % year, 'month=%i' % month)
+    tables = [read_log_table(f, columns=columns, filters=filters) for f in sorted(partition.glob('*.pqt'))]
+    if not tables:
+        return pd.DataFrame(columns=columns or COL_NAMES)
+    return pd.concat(tables, ignore_index=True)
@@ -2,24 +2,33 @@
 from datetime import datetime, timedelta
 from calendar import monthrange
 from pathlib import PurePosixPath, Path
+from tempfile import TemporaryDirectory
 import warnings
 from time import sleep
 import pickle
 from urllib.request import urlopen
+from urllib.error import URLError, HTTPError
 from ipaddress import IPv4Address, IPv6Address
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+import threading
 import json
 import time
 
 import pandas as pd
 import numpy as np
 import pyarrow as pa
+import pyarrow.dataset as ds
 import boto3
+from tqdm import tqdm
 from botocore.exceptions import ClientError
-from one.alf.path import get_session_path
 from itertools import zip_longest
 
 from . import io as s3io
 
+"""tuple of int: HTTP status codes of ipinfo API requests that are retried."""
+RETRY_HTTP_CODES = (429, 500, 502, 503, 504)
+
 
 def files_accessed_this_month():
     """Print the number of times each file was accessed this month"""
@@ -70,7 +79,8 @@ def week_of_month(dt):
     return week_number, (start, end)
 
 
-def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, profile_name='miles'):
+def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, profile_name='miles',
+                     ip_store=None, n_workers=8, ip_database=None, sync_ip_store=None):
     """
     Download last month's log files, upload as parquet table to S3 and delete individual log files.
 
@@ -93,6 +103,17 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
         An API token for using with the ipinfo API to query IP address location.
     profile_name: str
         The profile name of the boto s3 credentials
+    ip_store : str, pathlib.Path
+        The location of the local IP info table. IP addresses already in this table are not
+        queried again.
+    n_workers : int
+        The maximum number of concurrent IP info queries.
+    ip_database : pd.DataFrame, str, pathlib.Path, optional
+        An offline table of IP address details to use instead of the ipinfo API.
+    sync_ip_store : bool, optional
+        If true, the monthly IP info tables on S3 are merged into the local IP info table before
+        querying the new IP addresses.  By default they are only merged to seed a missing local
+        IP info table.
 
     Returns
     -------
@@ -103,12 +124,12 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
     """
     today = datetime.utcnow()
     if date == 'this_month':
-        partial = True
+        incomplete = True
         start_date = today.replace(day=1).date()
         start = datetime(*start_date.timetuple()[:3])
         end = today
     elif date == 'last_month':
-        partial = False
+        incomplete = False
         # The date range for last month
         month = today.month
         start_date = today.replace(
@@ -119,7 +140,7 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
     else:
         if isinstance(date, str):
             date = datetime.fromisoformat(date)
-        partial = (date.year, date.month) == (today.year, today.month)
+        incomplete = (date.year, date.month) == (today.year, today.month)
         start_date = date.replace(day=1).date()
         start = datetime(*start_date.timetuple()[:3])
         end = (start.replace(day=monthrange(start.year, start.month)[1]) +
@@ -136,7 +157,7 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
     assert next(iter(consolidated), False) is False, \
         'logs already consolidated for ' + start.strftime('%B')
 
-    print(f'Reading remote logs for {start.strftime("%B")}' + (' so far' if partial else ''))
+    print(f'Reading remote logs for {start.strftime("%B")}' + (' so far' if incomplete else ''))
     try:
         df = s3io.read_remote_logs(date_range=(start, end), log_location=s3io.REMOTE_LOG_LOCATION, s3_bucket=bucket)
     except pd.errors.ParserError as ex:
@@ -166,10 +187,11 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
         s3.Object(bucket_name=dst_bucket_name, key=partial_file.as_posix()).load()
         print('Downloading partial log table')
         bucket.download_file(partial_file.as_posix(), str(filepath))
-        df_ = pd.read_parquet(filepath)
+        df_ = s3io.prepare_for_parquet(pd.read_parquet(filepath))
         assert np.all(df['Bucket'].unique() == bucket_name), 'multiple bucket logs'
         print(f'Concatenating logs ({df_.size} + {df.size} rows)')
-        df = pd.concat([df_, df], ignore_index=True)
+        # Re-apply the data types as concatenating categoricals of different categories yields objects
+        df = s3io.prepare_for_parquet(pd.concat([df_, df], ignore_index=True))
     except ClientError as ex:
         if ex.response['Error']['Code'] != '404':
             raise ex
@@ -178,7 +200,7 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
     df.drop_duplicates(subset=None, keep='first', inplace=True, ignore_index=True)
 
     print('Uploading table')
-    s3io.upload_table(df, partial_file if partial else s3_url, bucket)
+    s3io.upload_table(df, partial_file if incomplete else s3_url, bucket, **s3io.PARQUET_OPTIONS)
 
     print('Deleting log files')
     for obj in s3io._iter_objects(s3io.REMOTE_LOG_LOCATION, date_range=(start, end), s3_bucket=bucket):
@@ -186,7 +208,7 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
         print(f'deleting {obj.key}')
         obj.delete()
 
-    if not partial:
+    if not incomplete:
         try:
             # Delete incomplete log table if exists
             bucket.objects.filter(Prefix=partial_file.as_posix()).delete()
@@ -197,7 +219,7 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
 
     print('Fetching IP info...')
     # Unique accesses
-    unique_ips = df.loc[:, 'Remote_IP'].unique()
+    unique_ips = s3io.bytes_to_ips(pd.Series(df['Remote_IP'].unique())).values
 
     print(f'Data was accessed from {len(unique_ips):,d} unique devices')
     # Attempt to download current IP info table, if exists
@@ -216,15 +238,20 @@ def consolidate_logs(boto_session=None, date='last_month', ipinfo_token=None, pr
         if '-' in unique_ips:
             print(f"Removing unknown IP with address '-'")
             unique_ips = np.setdiff1d(unique_ips, np.array('-'), assume_unique=True)
-        print(f'Querying location for {unique_ips.size} IPs')
-        ip_details = ip_info(unique_ips, wait=None, token=ipinfo_token)
-        ip_details = pd.DataFrame(ip_details).set_index('ip')
+        if sync_ip_store is None:
+            sync_ip_store = not Path(ip_store or s3io.LOCAL_IP_INFO_STORE).exists()
+        if sync_ip_store:
+            print('Syncing local IP info table')
+            s3io.sync_ip_info_store(ip_store, s3=s3, bucket_name=dst_bucket_name)
+        print(f'Fetching location for {unique_ips.size} IPs')
+        ip_details = update_ip_info(unique_ips, store_path=ip_store, token=ipinfo_token,
+                                    n_workers=n_workers, database=ip_database)
         if ip_details_ is not None:
             ip_details = pd.concat([ip_details_, ip_details], verify_integrity=True)
         print('Uploading IP table')
         s3io.upload_table(ip_details, ip_table_url, bucket)
 
-    return df, f's3://{dst_bucket_name}/{partial_file if partial else s3_url}'
+    return df, f's3://{dst_bucket_name}/{partial_file if incomplete else s3_url}'
 
 
 def key2date(key: str) -> datetime:
@@ -304,7 +331,7 @@ def consolidate_logs_by_week(boto_session=None):
         s3_url = PurePosixPath(s3io.REMOTE_LOG_LOCATION, 'consolidated', filename)
 
         print('Uploading table')
-        s3io.upload_table(df, s3_url, bucket)
+        s3io.upload_table(df, s3_url, bucket, **s3io.PARQUET_OPTIONS)
 
         print('Deleting log files')
         for obj in s3io._iter_objects(s3io.REMOTE_LOG_LOCATION, date_range=(start, end), s3_bucket=bucket):
@@ -316,11 +343,10 @@ def consolidate_logs_by_week(boto_session=None):
 
         print('Fetching IP info...')
         # Unique accesses
-        unique_ips = df.loc[:, 'Remote_IP'].unique()
+        unique_ips = s3io.bytes_to_ips(pd.Series(df['Remote_IP'].unique())).values
 
         print(f'Data was accessed from {len(unique_ips):,d} unique devices')
-        ip_details = ip_info(unique_ips, wait=.2)  # pause to avoid DoS
-        ip_details = pd.DataFrame(ip_details).set_index('ip')
+        ip_details = update_ip_info(unique_ips, wait=.2)  # pause to avoid DoS
         s3io.upload_table(ip_details, s3_url.with_name(s3_url.stem + '_IP-info.pqt'), bucket)
 
     return urls
@@ -328,39 +354,186 @@ def consolidate_logs_by_week(boto_session=None):
 
 def parse_time_column(df):
     """Converts the Time and Time_Offset string columns to pandas Datetime objects"""
+    if pd.api.types.is_datetime64_any_dtype(df['Time']):
+        return df['Time']  # already parsed by s3io.prepare_for_parquet
     return pd.to_datetime(df['Time'] + df['Time_Offset'], format='[%d/%b/%Y:%H:%M:%S%z]', utc=True)
 
 
-def ip_info(ip_address, wait=None, token=None):
+class RateLimiter:
+    """A thread-safe limiter enforcing a minimum interval between successive requests."""
+
+    def __init__(self, interval=None):
+        self.interval = float(interval or 0.)
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request slot is available."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+def _query_ipinfo(ip_address, token=None, retries=3, limiter=None, timeout=10):
+    """
+    Query the ipinfo.io API for a single IP address, retrying on transient errors.
+
+    Parameters
+    ----------
+    ip_address : str, IPv4Address, IPv6Address
+        The IP address to look up.
+    token : str, optional
+        An optional API token to use.
+    retries : int
+        The number of times to retry a request upon rate limiting, server or network errors.
+    limiter : RateLimiter, optional
+        A rate limiter shared between threads.
+    timeout : float
+        The request timeout in seconds.
+
+    Returns
+    -------
+    dict
+        The IP address lookup details.
+    """
+    url = f'https://ipinfo.io/{ip_address}' + (f'?token={token}' if token else '/json')
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.wait()
+        try:
+            with urlopen(url, timeout=timeout) as res:
+                return json.load(res)
+        except HTTPError as ex:
+            if ex.code not in RETRY_HTTP_CODES or attempt == retries:
+                raise ex
+        except (URLError, TimeoutError) as ex:
+            if attempt == retries:
+                raise ex
+        sleep(2 ** attempt)  # exponential back-off
+
+
+def _query_offline(ip_address, database):
+    """
+    Look up a single IP address in a local IP info table instead of querying the ipinfo API.
+
+    Parameters
+    ----------
+    ip_address : str, IPv4Address, IPv6Address
+        The IP address to look up.
+    database : pd.DataFrame
+        A table of IP address details indexed by IP address, e.g. the local IP info store.
+
+    Returns
+    -------
+    dict
+        The IP address lookup details. Only the 'ip' key is present if the address is unknown.
+    """
+    ip_address = str(ip_address)
+    try:
+        info = database.loc[ip_address].dropna().to_dict()
+    except KeyError:
+        info = {}
+    info['ip'] = ip_address
+    return info
+
+
+def ip_info(ip_address, wait=None, token=None, n_workers=1, retries=3, database=None):
     """
     Fetch DNS information associated with the IP address(es).
 
     Uses the public API of ipinfo.io. Use the wait arg if concerned about reaching request limit
-    for large IP lists.
+    for large IP lists. When more than one IP address is provided, up to `n_workers` requests are
+    made concurrently; IP addresses that could not be resolved are skipped with a warning.
 
     Parameters
     ----------
     ip_address : iterable, str, IPv4Address, IPv6Address
         One or more IP addresses to look up.
     wait : float, bool, optional
-        Whether to wait between API queries to avoid DoS.
+        The minimum time in seconds between API queries to avoid DoS.
     token : str, optional
         An optional API token to use.
+    n_workers : int
+        The maximum number of concurrent queries.
+    retries : int
+        The number of times to retry a query upon rate limiting, server or network errors.
+    database : pd.DataFrame, str, pathlib.Path, optional
+        An offline table of IP address details (or the path to one) indexed by IP address to use
+        instead of the ipinfo API.
 
     Returns
     -------
     dict, list of dict
         The IP address lookup details.
     """
-    if not isinstance(ip_address, (str, IPv4Address, IPv6Address)):
-        return [ip_info(ip, wait, token) for ip in ip_address if wait is None or not sleep(wait)]
+    if isinstance(database, (str, Path)):
+        database = pd.read_parquet(database)
+    if database is not None:
+        query = partial(_query_offline, database=database)
+    else:
+        query = partial(_query_ipinfo, token=token, retries=retries, limiter=RateLimiter(wait))
+
+    def _ip_info(ip):
+        info = query(ip)
+        info['accessed'] = datetime.utcnow().isoformat()
+        return info
+
+    if isinstance(ip_address, (str, IPv4Address, IPv6Address)):
+        return _ip_info(ip_address)
+
+    ip_address = list(ip_address)
+    details = []
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = {executor.submit(_ip_info, ip): ip for ip in ip_address}
+        for future in tqdm(as_completed(futures), total=len(futures), unit=' IPs'):
+            try:
+                details.append(future.result())
+            except (URLError, TimeoutError) as ex:
+                warnings.warn(f'Failed to fetch info for IP {futures[future]}: {ex}')
+    # Return in the same order as the input
+    order = {str(ip): i for i, ip in enumerate(ip_address)}
+    return sorted(details, key=lambda x: order.get(x.get('ip'), len(order)))
+
+
+def update_ip_info(ip_address, store_path=None, **kwargs):
+    """
+    Return the details of the given IP addresses, querying only those not in the local store.
 
-    url = f'https://ipinfo.io/{ip_address}' + (f'?token={token}' if token else '/json')
-    res = urlopen(url)
-    assert res
-    info = json.load(res)
-    info['accessed'] = datetime.utcnow().isoformat()
-    return info
+    Newly fetched IP details are added to the local IP info store, which spans all months. IP
+    addresses without details, e.g. those absent from an offline database, are not stored so that
+    they are looked up again next time.
+
+    Parameters
+    ----------
+    ip_address : iterable
+        One or more IP addresses to look up.
+    store_path : str, pathlib.Path
+        The location of the local IP info parquet table.
+    **kwargs
+        Optional arguments passed to `ip_info`, e.g. token, n_workers, database.
+
+    Returns
+    -------
+    pd.DataFrame
+        A data frame of IP address details indexed by IP address.
+    """
+    store = s3io.load_ip_info_store(store_path)
+    ip_address = np.unique(np.asarray(ip_address, dtype=str))
+    ip_address = np.setdiff1d(ip_address, np.array(['-']), assume_unique=True)
+    new_ips = np.setdiff1d(ip_address, store.index.values.astype(str), assume_unique=True)
+    print(f'{ip_address.size - new_ips.size:,d} IPs found in local store; querying {new_ips.size:,d} new IPs')
+    if new_ips.size:
+        details = [d for d in ip_info(new_ips, **kwargs) if d.keys() - {'ip', 'accessed'}]
+        if details:
+            store = pd.concat([store, pd.DataFrame(details).set_index('ip')])
+            s3io.save_ip_info_store(store, store_path)
+            store = store[~store.index.duplicated(keep='last')]
+    return store.loc[store.index.intersection(ip_address)]
 
 
 def SCGB_renewal():
@@ -369,7 +542,7 @@ def SCGB_renewal():
     # Download logs for this month
     file_obj = s3io.get_log_table_by_month(sfn_start_date)
     table = pa.BufferReader(file_obj.get()['Body'].read())
-    df = pd.read_parquet(table)
+    df = s3io.read_log_table(table)
 
     # Print number of files accessed
     file_access = (df['Operation'] == 'REST.GET.OBJECT') & (df['Key'].str.startswith('data/'))
@@ -400,7 +573,7 @@ def SCGB_renewal():
     print(f'{len(df.loc[file_access & at_sfn, "Key"]):,} datasets downloaded at SfN alone')
 
     # N sessions accessed
-    sessions = set(filter(None, map(get_session_path, datasets)))
+    sessions = set(s3io.parse_session_keys(datasets)['session_path'].dropna())
     print(f'{len(sessions):,} unique sessions accessed')
 
     print(df.loc[file_access, 'Key'].value_counts())
@@ -433,67 +606,60 @@ def grouper(iterable, n, *, incomplete='fill', fillvalue=None):
         raise ValueError('Expected fill, strict, or ignore')
 
 
-def get_access(YEAR=None, save_path=None, save=False):
+def get_access(YEAR=None, store_location=None, sync=False):
     """
-    Get summary of data for all data or given year
-    :param YEAR:
-    :return:
+    Get summary of data access for all data or given year.
+
+    The consolidated logs are read from the local log store (see `s3io.sync_log_store`),
+    one month at a time and only the columns required.
+
+    Parameters
+    ----------
+    YEAR : int, str, optional
+        Only summarize the data access for this year.
+    store_location : str, pathlib.Path
+        The location of the local log store.
+    sync : bool
+        If true, download any consolidated log tables missing from the local log store first.
+
+    Returns
+    -------
+    pd.DataFrame
+        A summary table of data access per month.
+    dict of set
+        The unique file keys, IP addresses, countries, cities and sessions accessed over the
+        whole period.
     """
+    if sync:
+        s3io.sync_log_store(store_location)
     columns = [
         'total_file_access', 'unique_file_access', 'total_bytes_sent', 'date', 'unique_ips',
         'unique_countries', 'unique_cities', 'unique_sessions', 'cache_access']
-    download_data = pd.DataFrame(columns=columns)
+    download_data = []
 
     total_unique = {k: set() for k in ['file_access', 'ips', 'countries', 'cities', 'sessions']}
 
-    for log_obj, ip_obj in grouper(s3io.iter_log_tables(), 2):
-        assert 'ibl-brain-wide-map-public' in log_obj.key
-        assert ip_obj is None or 'IP-info' in ip_obj.key
-
-        if YEAR and YEAR not in log_obj.key:
-            continue  # only look at the year
-
-        if save_path is not None:
-            log_obj_path = Path(save_path).joinpath(PurePosixPath(log_obj.key).name)
-            if log_obj_path.exists():
-                df = pd.read_parquet(log_obj_path)
-            else:
-                table = pa.BufferReader(log_obj.get()['Body'].read())
-                df = pd.read_parquet(table)
-                if save:
-                    df.to_parquet(log_obj_path)
-        else:
-            table = pa.BufferReader(log_obj.get()['Body'].read())
-            df = pd.read_parquet(table)
-
-        data = {'date': PurePosixPath(log_obj.key).name[:7]}
+    for year, month in s3io.iter_log_store_months(store_location, year=YEAR):
+        expr = ds.field('Operation') == 'REST.GET.OBJECT'
+        df = s3io.read_log_store_month(
+            year, month, columns=['Key', 'Remote_IP', 'Bytes_Sent'], filters=expr, store_location=store_location)
+
+        data = {'date': f'{year:04d}-{month:02d}'}
         # Print number of files accessed
-        file_access = (df['Operation'] == 'REST.GET.OBJECT') & (df['Key'].str.startswith('data/'))
+        file_access = df['Key'].str.startswith('data/')
+        datasets = df.loc[file_access, 'Key'].unique()
         print(f'{sum(file_access):,} total downloads for the month of {data["date"]}')
-        print(f'{len(df.loc[file_access, "Key"].unique()):,} different datasets downloaded')
+        print(f'{len(datasets):,} different datasets downloaded')
         data['total_file_access'] = sum(file_access)
-        data['unique_file_access'] = len(df.loc[file_access, 'Key'].unique())
-        data['total_bytes_sent'] = sum(df.loc[file_access, 'Bytes_Sent'])
+        data['unique_file_access'] = len(datasets)
+        data['total_bytes_sent'] = df.loc[file_access, 'Bytes_Sent'].sum()
 
         # Unique accesses
         unique_ips = df.loc[file_access, 'Remote_IP'].unique()
         total_unique['ips'].update(unique_ips)
         print(f'Data was accessed from {len(unique_ips)} unique devices')
         data['unique_ips'] = len(unique_ips)
-        if ip_obj:
-            if save_path is not None:
-                ip_obj_path = Path(save_path).joinpath(PurePosixPath(ip_obj.key).name)
-                if ip_obj_path.exists():
-                    ip_info = pd.read_parquet(ip_obj_path)
-                else:
-                    ip_info = pa.BufferReader(ip_obj.get()['Body'].read())
-                    ip_info = pd.read_parquet(ip_info)
-                    if save:
-                        ip_info.to_parquet(ip_obj_path)
-            else:
-                ip_info = pa.BufferReader(ip_obj.get()['Body'].read())
-                ip_info = pd.read_parquet(ip_info)
-
+        if (ip_info := s3io.load_ip_info_month(year, month, store_location)) is not None:
             unique_cities = ip_info['city'].str.cat(ip_info[['region', 'country']], sep='/', na_rep='Unknown').unique()
             total_unique['cities'].update(unique_cities)
             data['unique_cities'] = len(unique_cities)
@@ -502,76 +668,108 @@ def get_access(YEAR=None, save_path=None, save=False):
             total_unique['countries'].update(unique_countries)
 
         # N sessions accessed
-        datasets = df.loc[file_access, 'Key'].unique()
-        sessions = set(map(get_session_path, datasets))
+        sessions = set(s3io.parse_session_keys(datasets)['session_path'].dropna())
         print(f'{len(sessions):,} unique sessions accessed')
         data['unique_sessions'] = len(sessions)
         total_unique['sessions'].update(sessions)
-        total_unique['file_access'].update(df.loc[file_access, 'Key'].unique())
+        total_unique['file_access'].update(datasets)
 
         # ONE cache downloads
-        cache_access = (df['Operation'] == 'REST.GET.OBJECT') & \
-                       (df['Key'].str.match(r'caches/openalyx/[a-zA-Z0-9_/]*cache.zip'))
-        # df.loc[cache_access, 'Key'].unique()
+        cache_access = df['Key'].str.match(r'caches/openalyx/[a-zA-Z0-9_/]*cache.zip')
         print(f'Public ONE cache was downloaded a total of {sum(cache_access):,} times')
         data['cache_access'] = sum(cache_access)
 
-        download_data = pd.concat([download_data, pd.DataFrame(data, index=[0])])
+        download_data.append(data)
 
     print(
         f'So far data accessed from {len(total_unique["cities"])} different cities '
         f'across {len(total_unique["countries"])} countries'
     )
 
-    download_data = download_data.set_index('date')
+    download_data = pd.DataFrame(download_data, columns=columns).set_index('date')
 
     return download_data, total_unique
 
 
-def get_file_count_by_ip(save_path=None, save=False):
+def get_file_count_by_ip(store_location=None, sync=False):
+    """
+    Get the number of files downloaded by each IP address per month.
+
+    The consolidated logs are read from the local log store (see `s3io.sync_log_store`),
+    one month at a time and only the columns required.
+
+    Parameters
+    ----------
+    store_location : str, pathlib.Path
+        The location of the local log store.
+    sync : bool
+        If true, download any consolidated log tables missing from the local log store first.
 
-    all_df = pd.DataFrame()
-    for log_obj, ip_obj in grouper(s3io.iter_log_tables(), 2):
+    Returns
+    -------
+    pd.DataFrame
+        A table of IP addresses with the columns ('ip', 'count', 'date', 'city', 'region',
+        'country').
+    """
+    if sync:
+        s3io.sync_log_store(store_location)
+    all_df = []
+    for year, month in s3io.iter_log_store_months(store_location):
+        expr = ds.field('Operation') == 'REST.GET.OBJECT'
+        df = s3io.read_log_store_month(
+            year, month, columns=['Remote_IP'], filters=expr, store_location=store_location)
+        info = df['Remote_IP'].value_counts()
+        df_ip = pd.DataFrame({'ip': info.index, 'count': info.values,
+                              'date': f'{year:04d}-{month:02d}'})
 
-        assert 'ibl-brain-wide-map-public' in log_obj.key
-        assert ip_obj is None or 'IP-info' in ip_obj.key
+        if (ip_info := s3io.load_ip_info_month(year, month, store_location)) is not None:
+            ip_info = ip_info[['city', 'region', 'country']]
+            ip_info = ip_info.rename_axis('ip').reset_index()
+            df_ip = df_ip.merge(ip_info, how='outer', on='ip')
+            df_ip['date'] = f'{year:04d}-{month:02d}'
+        all_df.append(df_ip)
 
-        if save_path is not None:
-            log_obj_path = Path(save_path).joinpath(PurePosixPath(log_obj.key).name)
-            if log_obj_path.exists():
-                df = pd.read_parquet(log_obj_path)
-            else:
-                table = pa.BufferReader(log_obj.get()['Body'].read())
-                df = pd.read_parquet(table)
-                if save:
-                    df.to_parquet(log_obj_path)
-        else:
-            table = pa.BufferReader(log_obj.get()['Body'].read())
-            df = pd.read_parquet(table)
+    columns = ['ip', 'count', 'date', 'city', 'region', 'country']
+    return pd.concat(all_df, ignore_index=True) if all_df else pd.DataFrame(columns=columns)
 
-        # Get number of files accessed
-        file_access = (df['Operation'] == 'REST.GET.OBJECT')
 
-        info = df.loc[file_access, 'Remote_IP'].value_counts()
-        df_ip = pd.DataFrame({'ip': info.index, 'count': info.values,
-                              'date': PurePosixPath(log_obj.key).name[:7] })
-
-        if save_path is not None:
-            ip_obj_path = Path(save_path).joinpath(PurePosixPath(ip_obj.key).name)
-            if ip_obj_path.exists():
-                ip_info = pd.read_parquet(ip_obj_path)
-            else:
-                ip_info = pa.BufferReader(ip_obj.get()['Body'].read())
-                ip_info = pd.read_parquet(ip_info)
-                if save:
-                    ip_info.to_parquet(ip_obj_path)
-        else:
-            ip_info = pa.BufferReader(ip_obj.get()['Body'].read())
-            ip_info = pd.read_parquet(ip_info)
-
-        ip_info = ip_info[['city', 'region', 'country']]
-        ip_info = ip_info.reset_index()
-
-        all_df = pd.concat([all_df, df_ip.merge(ip_info, how='outer', on='ip')])
-
-    return all_df
\ No newline at end of file
+def benchmark_parquet_layout(date, columns=('Operation', 'Key', 'Remote_IP', 'Bytes_Sent')):
+    """
+    Compare the size and load time of a month's log table in the legacy and typed parquet layout.
+
+    The legacy layout is the table as read from an untyped consolidated log table, saved with
+    the default parquet options; the typed layout is the output of `s3io.prepare_for_parquet`
+    saved with `s3io.PARQUET_OPTIONS`.
+
+    Parameters
+    ----------
+    date : datetime.datetime, str
+        A date within the month of the consolidated log table to benchmark.
+    columns : iterable of str
+        The columns to load for the partial load benchmark.
+
+    Returns
+    -------
+    pd.DataFrame
+        A table with the file size (MB) and full and partial load times (s) of each layout.
+    """
+    file_obj = s3io.get_log_table_by_month(pd.Timestamp(date))
+    df = s3io.read_log_table(pa.BufferReader(file_obj.get()['Body'].read()))
+    if pd.api.types.is_datetime64_any_dtype(df['Time']):
+        raise ValueError('log table already saved in the typed layout')
+    typed = s3io.prepare_for_parquet(df.copy())
+    results = {}
+    with TemporaryDirectory() as tdir:
+        for layout, table, kwargs in (('legacy', df, {}), ('typed', typed, s3io.PARQUET_OPTIONS)):
+            filepath = Path(tdir, f'{layout}.pqt')
+            table.to_parquet(filepath, **kwargs)
+            t0 = time.perf_counter()
+            s3io.read_log_table(filepath)
+            t1 = time.perf_counter()
+            s3io.read_log_table(filepath, columns=list(columns))
+            t2 = time.perf_counter()
+            results[layout] = {
+                'size_mb': filepath.stat().st_size / 1024 ** 2, 'load_s': t1 - t0, 'load_columns_s': t2 - t1}
+    results = pd.DataFrame(results).T
+    print(results)
+    return results